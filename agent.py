@@ -1,11 +1,23 @@
 import paho.mqtt.client as mqtt
+import asyncio
+import random
+import socket
+import threading
 from init import *
+from spool import Spool, spool_path
 from icecream import ic
 from datetime import datetime
 
 # Configure logging format
 ic.configureOutput(prefix=lambda: f'{datetime.now()}  Agent|> ', includeContext=False)
 
+
+# Reconnect backoff: exponential with full jitter, so devices that lost the broker
+# together do not all come back at the same moment
+def backoff_delay(attempt):
+    return random.uniform(0, min(mqtt_reconnect_max_delay, mqtt_reconnect_min_delay * 2 ** attempt))
+
+
 class MqttClient:
     def __init__(self):
         # Initialize connection parameters
@@ -21,17 +33,28 @@ class MqttClient:
         self.on_connected_to_form = ''
         self.connected = False
         self.subscribed = False
+        self.spool = None  # outbound spool, spool_dir/<clientname>.spool unless set
+        self.clean_session = mqtt_clean_session  # persistent sessions need a client name stable across runs
+        self.client = None  # one paho client per MqttClient, reused by every reconnect
+        self.subscriptions = {}  # topic -> qos, replayed after a reconnect without a broker session
+        self.changes = {}  # topic -> qos, None for unsubscribe: made while offline, sent on connect
+        self.auto_reconnect = True
+        self._stop = threading.Event()
+        self._loop_thread = None
 
     # Setters and getters
     def set_on_connected_to_form(self, func): self.on_connected_to_form = func
     def set_broker(self, value): self.broker = value
     def set_port(self, value): self.port = value
     def set_clientname(self, value): self.clientname = value
+    set_clientName = set_clientname  # name used by gui.py/emulator.py
     def set_username(self, value): self.username = value
     def set_password(self, value): self.password = value
     def set_subscribeTopic(self, value): self.subscribeTopic = value
     def set_publishTopic(self, value): self.publishTopic = value
     def set_publishMessage(self, value): self.publishMessage = value
+    def set_spool(self, value): self.spool = value
+    def set_clean_session(self, value): self.clean_session = value
 
     def get_broker(self): return self.broker
     def get_port(self): return self.port
@@ -42,47 +65,433 @@ class MqttClient:
     def get_publishTopic(self): return self.publishTopic
     def get_publishMessage(self): return self.publishMessage
 
+    def get_spool(self):
+        if self.spool is None:
+            self.spool = Spool(spool_path(self.clientname))
+        return self.spool
+
     # MQTT client callbacks
     def on_log(self, client, userdata, level, buf): ic(f"log: {buf}")
     def on_connect(self, client, userdata, flags, rc):
         self.connected = rc == 0
         if self.connected:
             ic("Connected OK")
-            self.on_connected_to_form()
+            sync_subscriptions(self.client, flags, self.subscriptions, self.changes)
+            self.subscribed = bool(self.subscriptions)
+            if self.on_connected_to_form:
+                self.on_connected_to_form()
+            self.get_spool().drain_async(self.send, lambda: self.connected)
         else:
             ic(f"Bad connection. Returned code={rc}")
 
-    def on_disconnect(self, client, userdata, flags, rc=0):
+    def on_disconnect(self, client, userdata, rc=0, *args):
         self.connected = False
+        self.subscribed = False
         ic(f"Disconnected. Result code {rc}")
 
     def on_message(self, client, userdata, msg):
         ic(f"Message from {msg.topic}: {msg.payload.decode('utf-8', 'ignore')}")
 
     # MQTT client operations
+    # The paho client is created once; later calls (e.g. emulator.ensure_connected) leave
+    # reconnecting to the loop of start_listening() instead of opening a new client.
     def connect_to(self):
-        self.client = mqtt.Client(self.clientname, clean_session=True)
+        self.auto_reconnect = True
+        if self.client is not None:
+            if self._loop_thread is None and not self.connected:
+                self.reconnect()
+            return
+        self.client = mqtt.Client(self.clientname, clean_session=self.clean_session)
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_log = self.on_log
         self.client.on_message = self.on_message
         self.client.username_pw_set(self.username, self.password)
         ic(f"Connecting to broker {self.broker}")
-        self.client.connect(self.broker, self.port)
+        self.client.connect_async(self.broker, self.port)
+        self.reconnect()
 
-    def disconnect_from(self): self.client.disconnect()
-    def start_listening(self): self.client.loop_start()
-    def stop_listening(self): self.client.loop_stop()
+    def reconnect(self):
+        """
+        :return: True if the TCP connection was opened (CONNACK follows in the loop)
+        """
+        try:
+            self.client.reconnect()
+            return True
+        except (OSError, ValueError) as e:
+            ic(f"Cannot connect to {self.broker}: {e}")
+            return False
 
-    def subscribe_to(self, topic):
-        if self.connected:
-            self.client.subscribe(topic)
+    def disconnect_from(self):
+        self.auto_reconnect = False
+        self.client.disconnect()
+
+    def start_listening(self):
+        if self._loop_thread is None:
+            self._stop.clear()
+            self._loop_thread = threading.Thread(target=self._loop, name='mqtt-' + self.clientname, daemon=True)
+            self._loop_thread.start()
+
+    def stop_listening(self):
+        self._stop.set()
+        if self._loop_thread is not None:
+            self._loop_thread.join()
+            self._loop_thread = None
+
+    # Network loop with reconnects (backoff_delay between attempts)
+    def _loop(self):
+        attempt = 0
+        while not self._stop.is_set():
+            rc = self.client.loop(timeout=1.0)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                if self.connected:
+                    attempt = 0
+                continue
+            if not self.auto_reconnect:
+                self._stop.wait(1.0)
+                continue
+            delay = backoff_delay(attempt)
+            attempt += 1
+            ic(f"Reconnecting in {delay:.1f}s (attempt {attempt})")
+            if self._stop.wait(delay):
+                break
+            self.reconnect()
+
+    # Subscriptions are registered and (re)sent whenever a connection is established
+    def subscribe_to(self, topic, qos=0):
+        self.subscriptions[topic] = qos
+        if self.connected and self.client.subscribe(topic, qos)[0] == mqtt.MQTT_ERR_SUCCESS:
             self.subscribed = True
         else:
-            ic("Cannot subscribe. Connection must be established first.")
+            self.changes[topic] = qos
+            ic(f"Subscription to {topic} is sent once connected.")
 
-    def publish_to(self, topic, message):
+    def unsubscribe_from(self, topic):
+        self.subscriptions.pop(topic, None)
+        if not (self.connected and self.client.unsubscribe(topic)[0] == mqtt.MQTT_ERR_SUCCESS):
+            self.changes[topic] = None
+        self.subscribed = bool(self.subscriptions) and self.connected
+
+    # Publishes while disconnected, or while older ones are still spooled, go to the spool
+    def publish_to(self, topic, message, qos=0, retain=False):
+        spool = self.get_spool()
+        if self.connected and not spool.pending() and self.send(topic, message, qos, retain):
+            return
+        spool.put(topic, message, qos, retain)
         if self.connected:
-            self.client.publish(topic, message)
-        else:
-            ic("Cannot publish. Connection must be established first.")
+            spool.drain_async(self.send, lambda: self.connected)
+
+    def send(self, topic, message, qos=0, retain=False):
+        return self.client.publish(topic, message, qos, retain).rc == mqtt.MQTT_ERR_SUCCESS
+
+
+Mqtt_client = MqttClient  # name imported by gui.py/emulator.py
+
+
+def sync_subscriptions(client, flags, subscriptions, changes):
+    """
+    Bring the broker's subscriptions in line with the registry on CONNACK: a new session gets
+    all of them, a resumed one the (un)subscribes made while offline.
+    :param changes: topic -> qos (None - unsubscribe) made while offline; emptied
+    """
+    if not flags.get('session present'):
+        for topic, qos in subscriptions.items():
+            client.subscribe(topic, qos)
+    else:
+        for topic, qos in changes.items():
+            if qos is None:
+                client.unsubscribe(topic)
+            else:
+                client.subscribe(topic, qos)
+    changes.clear()
+
+
+class TopicRouter:
+    """
+    Dispatch messages to handlers registered by MQTT topic filter ('+' one level, '#' the rest).
+    Filters are stored in a trie of topic levels, so resolving a topic costs O(topic depth)
+    whatever the number of handlers, and each resolved topic is cached until the routes change.
+    usage: router.add(comm_topic + '/+/pub', handler); router.dispatch(msg.topic, msg)
+    """
+
+    def __init__(self, cache_size=router_cache_size):
+        self.root = {}  # level -> child node; the node's handlers under the key None
+        self.cache = {}
+        self.cache_size = cache_size
+        self.routes = []  # (topic filter, handler) in registration order
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, handler):
+        """
+        Register a handler; handlers run in registration order.
+        """
+        levels = topic_filter.split('/')
+        if '#' in levels[:-1] or any(('+' in level or '#' in level) and len(level) > 1 for level in levels):
+            raise ValueError('Invalid topic filter: ' + topic_filter)
+        with self._lock:
+            node = self.root
+            for level in levels:
+                node = node.setdefault(level, {})
+            node.setdefault(None, []).append((len(self.routes), handler))
+            self.routes.append((topic_filter, handler))
+            self.cache = {}
+
+    def remove(self, topic_filter, handler=None):
+        """
+        Unregister the handler (all handlers of the filter when None).
+        """
+        with self._lock:
+            node = self.root
+            for level in topic_filter.split('/'):
+                node = node.get(level)
+                if node is None:
+                    return
+            node[None] = [(seq, h) for seq, h in node.get(None, []) if handler is not None and h != handler]
+            self.routes = [(f, h) for f, h in self.routes
+                           if f != topic_filter or (handler is not None and h != handler)]
+            self.cache = {}
+
+    def route(self, topic_filter):
+        """
+        Decorator form of add().
+        """
+        def register(handler):
+            self.add(topic_filter, handler)
+            return handler
+        return register
+
+    def match(self, topic):
+        """
+        :return: tuple of the handlers whose filter matches the topic
+        """
+        handlers = self.cache.get(topic)
+        if handlers is None:
+            found = []
+            self._collect(self.root, topic.split('/'), 0, found)
+            handlers = tuple(h for seq, h in sorted(found, key=lambda item: item[0]))
+            if len(self.cache) >= self.cache_size:
+                self.cache = {}
+            self.cache[topic] = handlers
+        return handlers
+
+    def _collect(self, node, levels, i, found):
+        # wildcards do not match the first level of '$' topics (broker internals)
+        wild = i > 0 or not levels[0].startswith('$')
+        if wild and '#' in node:
+            found += node['#'].get(None, [])  # '#' also matches the parent level
+        if i == len(levels):
+            found += node.get(None, [])
+            return
+        child = node.get(levels[i])
+        if child is not None:
+            self._collect(child, levels, i + 1, found)
+        if wild and '+' in node:
+            self._collect(node['+'], levels, i + 1, found)
+
+    def dispatch(self, topic, *args):
+        """
+        Call the matching handlers as handler(*args).
+        :return: number of handlers called
+        """
+        handlers = self.match(topic)
+        for handler in handlers:
+            handler(*args)
+        return len(handlers)
+
+    def filters(self):
+        """
+        :return: the distinct registered topic filters, e.g. to subscribe to
+        """
+        return list(dict.fromkeys(f for f, h in self.routes))
+
+
+class AsyncMqttClient:
+    """
+    asyncio variant of MqttClient: paho handles the protocol while the running event loop does the
+    socket I/O through paho's external-loop callbacks, so any number of clients share one thread.
+    Reconnects with backoff_delay and replays the subscriptions like MqttClient.
+    usage:
+        mc = AsyncMqttClient('Dev-1'); await mc.connect()
+        await mc.subscribe(topic); await mc.publish(topic, payload)
+        async for msg in mc.messages(): ...
+    """
+
+    def __init__(self, clientname, broker=broker_ip, port=port, username=username, password=password,
+                 clean_session=mqtt_clean_session, queue_size=ingest_queue_size):
+        self.clientname = clientname
+        self.broker = broker
+        self.port = int(port)
+        self.connected = asyncio.Event()  # set while connected
+        self.disconnected = asyncio.Event()  # set while not connected
+        self.disconnected.set()
+        self.subscriptions = {}  # topic -> qos, replayed after a reconnect without a broker session
+        self.changes = {}  # topic -> qos, None for unsubscribe: made while offline, sent on connect
+        self.auto_reconnect = True
+        self.queue = asyncio.Queue(queue_size)  # received messages for messages()
+        self.dropped = 0
+        self.client = mqtt.Client(clientname, clean_session=clean_session)
+        if username != "":
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.on_publish = self.on_done
+        self.client.on_subscribe = lambda client, userdata, mid, granted_qos: self.on_done(client, userdata, mid)
+        self.client.on_unsubscribe = self.on_done
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self._pending = {}  # mid -> future of publish()/subscribe()
+        self._done = set()  # mids acknowledged before their future was registered
+        self._loop = None
+        self._task = None
+
+    # paho external-loop callbacks: the event loop watches the socket
+    def on_socket_open(self, client, userdata, sock): self._loop.add_reader(sock, client.loop_read)
+    def on_socket_close(self, client, userdata, sock): self._loop.remove_reader(sock)
+    def on_socket_register_write(self, client, userdata, sock): self._loop.add_writer(sock, client.loop_write)
+    def on_socket_unregister_write(self, client, userdata, sock): self._loop.remove_writer(sock)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            ic(f"{self.clientname}: bad connection. Returned code={rc}")
+            return
+        sync_subscriptions(client, flags, self.subscriptions, self.changes)
+        self.disconnected.clear()
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc=0, *args):
+        self.connected.clear()
+        self.disconnected.set()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self.clientname}: disconnected ({rc})"))
+        self._pending.clear()
+
+    def on_message(self, client, userdata, msg):
+        if self.queue.full():
+            self.queue.get_nowait()  # the consumer is behind: drop the oldest
+            self.dropped += 1
+        self.queue.put_nowait(msg)
+
+    def on_done(self, client, userdata, mid):
+        future = self._pending.pop(mid, None)
+        if future is None:
+            self._done.add(mid)
+        elif not future.done():
+            future.set_result(mid)
+
+    async def connect(self, timeout=mqtt_connect_timeout):
+        """
+        Connect and keep the connection up (reconnecting) until disconnect().
+        :param timeout: sec to wait for the first CONNACK, None - until connected
+        :return: True if connected (else it keeps trying in the background)
+        """
+        self._loop = asyncio.get_running_loop()
+        self.auto_reconnect = True
+        if self._task is None:
+            self.client.connect_async(self.broker, self.port)
+            self._task = self._loop.create_task(self._run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _run(self):
+        """
+        Keepalive housekeeping and reconnects with backoff_delay.
+        """
+        attempt = 0
+        while self.auto_reconnect:
+            if self.client.socket() is None:
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt - 1))
+                attempt += 1
+                try:
+                    sock = await self.open_socket()
+                    # paho 1.x connects with a blocking socket.create_connection: hand it ours instead
+                    self.client._create_socket_connection = lambda: sock
+                    self.client.reconnect()
+                except (OSError, ValueError, asyncio.TimeoutError) as e:
+                    ic(f"{self.clientname}: cannot connect to {self.broker}: {e!r}")
+                    continue
+            elif self.connected.is_set():
+                attempt = 0
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    async def open_socket(self, timeout=mqtt_connect_timeout):
+        """
+        Resolve and connect the broker's address on the event loop, without blocking it.
+        :return: connected non-blocking socket
+        """
+        infos = await self._loop.getaddrinfo(self.broker, self.port, type=socket.SOCK_STREAM)
+        error = OSError(f"no address for {self.broker}")
+        for family, kind, proto, _, address in infos:
+            sock = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(self._loop.sock_connect(sock, address), timeout)
+                return sock
+            except (OSError, asyncio.TimeoutError) as e:
+                sock.close()
+                error = e
+        raise error
+
+    async def disconnect(self):
+        self.auto_reconnect = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.client.disconnect()
+
+    async def _acknowledged(self, rc, mid):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"{self.clientname}: {mqtt.error_string(rc)}")
+        if mid in self._done:
+            self._done.discard(mid)
+            return mid
+        future = self._pending[mid] = self._loop.create_future()
+        return await future
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        """
+        Publish once connected; returns when the message is written (qos 0) or acknowledged (qos 1/2).
+        :return: message id
+        """
+        await self.connected.wait()
+        info = self.client.publish(topic, payload, qos, retain)
+        return await self._acknowledged(info.rc, info.mid)
+
+    async def subscribe(self, topic, qos=0):
+        """
+        Register a subscription; sent now when connected (returns on SUBACK), else on connect.
+        """
+        self.subscriptions[topic] = qos
+        if self.connected.is_set():
+            rc, mid = self.client.subscribe(topic, qos)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                await self._acknowledged(rc, mid)
+                return
+        self.changes[topic] = qos
+
+    async def unsubscribe(self, topic):
+        """
+        Drop a subscription; sent now when connected (returns on UNSUBACK), else on connect.
+        """
+        self.subscriptions.pop(topic, None)
+        if self.connected.is_set():
+            rc, mid = self.client.unsubscribe(topic)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                await self._acknowledged(rc, mid)
+                return
+        self.changes[topic] = None
+
+    async def messages(self):
+        """
+        Async iterator over the received messages (paho MQTTMessage).
+        """
+        while True:
+            yield await self.queue.get()
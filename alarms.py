@@ -0,0 +1,142 @@
+# Alarm state machine, rate limiting and coalesced summaries
+# Every alarm key (device/rule) is either raised or cleared. Only the transitions are published,
+# each key has a token bucket limiting how often it may publish, and everything that was held
+# back - repeated readings of a raised alarm, transitions over the rate limit - is reported in one
+# summary message per alarm_summary_interval. Alarm traffic follows state changes, not time.
+import threading
+import time
+from init import *
+from icecream import ic
+
+
+class TokenBucket:
+    """
+    Token bucket: up to `burst` tokens, refilled at `rate` tokens per sec.
+    """
+
+    def __init__(self, rate=alarm_rate, burst=alarm_burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = None
+
+    def take(self, now=None):
+        """
+        :return: True if a token was available (and is now used)
+        """
+        now = time.monotonic() if now is None else now
+        if self.stamp is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AlarmManager:
+    """
+    Raised/cleared state per alarm key with per-key rate limiting.
+    usage: alarms = AlarmManager(client.publish); alarms.update(key, state, topic, msg) per rule result,
+           alarms.flush() periodically for the summaries
+    """
+
+    def __init__(self, publish, rate=alarm_rate, burst=alarm_burst, summary_interval=alarm_summary_interval):
+        """
+        :param publish: called as publish(topic, message)
+        """
+        self.publish = publish
+        self.rate = rate
+        self.burst = burst
+        self.summary_interval = summary_interval
+        self.raised = {}  # key -> topic of the raised alarms
+        self.buckets = {}
+        self.held = {}  # key -> [topic, readings while raised, transitions not published, last message]
+        self.published = self.suppressed = 0
+        self.last_summary = None  # set by the first update
+        self._lock = threading.Lock()
+
+    def update(self, key, state, topic, msg, now=None):
+        """
+        Feed one rule result.
+        :param state: True - alarm condition, False - clear condition
+        :return: True if a message was published
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if state == (key in self.raised):
+                if state:
+                    self._hold(key, topic, msg)[1] += 1  # still raised: counted for the summary
+                send = False
+            else:
+                if state:
+                    self.raised[key] = topic
+                else:
+                    del self.raised[key]
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+                send = bucket.take(now)
+                if not send:
+                    self._hold(key, topic, msg)[2] += 1
+            if send:
+                self.published += 1
+            if self.last_summary is None:
+                self.last_summary = now
+            due = now - self.last_summary >= self.summary_interval
+        if send:
+            ic(msg)
+            self.publish(topic, msg)
+        if due:
+            self.flush(now)
+        return send
+
+    def _hold(self, key, topic, msg):
+        held = self.held.get(key)
+        if held is None:
+            held = self.held[key] = [topic, 0, 0, msg]
+        held[3] = msg
+        self.suppressed += 1
+        return held
+
+    def flush(self, now=None):
+        """
+        Publish one summary per topic of what was held back since the last summary.
+        :return: number of summary messages
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            held, self.held = self.held, {}
+            period = 0 if self.last_summary is None else now - self.last_summary
+            self.last_summary = now
+            raised = dict(self.raised)
+        topics = {}
+        for key, (topic, repeats, limited, msg) in sorted(held.items()):
+            state = 'raised' if key in raised else 'cleared'
+            parts = [key + ' ' + state]
+            if repeats:
+                parts.append(str(repeats) + ' repeats')
+            if limited:
+                parts.append(str(limited) + ' rate limited')
+            topics.setdefault(topic, []).append(', '.join(parts) + ' (last: ' + msg + ')')
+        for topic, lines in topics.items():
+            msg = 'Alarm summary, last ' + str(round(period)) + 's: ' + '; '.join(lines)
+            ic(msg)
+            self.publish(topic, msg)
+        return len(topics)
+
+    def flush_due(self, now=None):
+        """
+        Publish the summaries if alarm_summary_interval has passed (for the periodic loop).
+        """
+        now = time.monotonic() if now is None else now
+        if self.last_summary is not None and now - self.last_summary >= self.summary_interval:
+            return self.flush(now)
+        return 0
+
+    def active(self):
+        """
+        :return: sorted keys of the raised alarms
+        """
+        with self._lock:
+            return sorted(self.raised)
@@ -2,7 +2,6 @@ import time
 from speech import *
 import data_acquisition as da
 from init import *
-import pandas as pd
 from pocketsphinx import LiveSpeech  # Live speech recognition
 from icecream import ic as icA
 from datetime import datetime
@@ -95,17 +94,18 @@ class BOT():
 
                 # Process response to the status report offer
                 if "yes" in userresponcestring:
-                    # Fetch and process data from data acquisition module
-                    dfW = da.fetch_data(db_name, 'data', 'SensitivityMeter').value
-                    W_report = str((pd.to_numeric(dfW, errors='ignore', downcast='float')).mean()) if len(
-                        dfW) > 0 else 'currently unavailable'
-
-                    dfE = da.fetch_data(db_name, 'data', 'ElectricityMeter').value
-                    E_report = str((pd.to_numeric(dfE, errors='ignore', downcast='float')).mean()) if len(
-                        dfE) > 0 else 'currently unavailable'
+                    # Average consumption from the rollup tables (both meters from one DB snapshot)
+                    with da.read_snapshot():
+                        W_avg = da.rollup_stats('SensitivityMeter')[2]
+                        E_avg = da.rollup_stats('ElectricityMeter')[2]
+                        E_last = da.get_latest('ElectricityMeter')
+                    W_report = str(W_avg) if W_avg is not None else 'currently unavailable'
+                    E_report = str(E_avg) if E_avg is not None else 'currently unavailable'
 
                     # Create report message
                     text_msg = f'The current home state: electricity average consumption is {E_report} kiloWatt per hour and operated under normal condition, Sensitivity average consumption is {W_report} cubic meters per hour and it is usual to current season'
+                    if E_last is not None:
+                        text_msg += f'. The last electricity reading is {E_last[1]} kiloWatt per hour'
                     ts.save2file(ts.tts_request(text_msg), ttsfile)
                     time.sleep(sys_delay)
                     pl.play(ttsfile)
@@ -0,0 +1,119 @@
+# Multi-process reader/writer contention benchmark for the SafeSleep DB
+# usage: python bench_db_contention.py [seconds] [readers] [busy_timeout_ms]
+# The same load runs once per journal mode (DELETE - rollback journal, WAL) on a scratch DB:
+# one writer process committing readings through add_IOT_data like the manager, and
+# reader processes running filter_by_date range queries like the GUI and the assistant.
+import sys
+import os
+import time
+import tempfile
+import sqlite3
+import multiprocessing as mp
+from init import *
+import data_acquisition as da
+
+meter = 'BenchMeter'
+start_ts = da.to_epoch('2021-05-01')
+preload_rows = 50000
+step = 10  # sec between readings
+
+
+def setup(path, mode):
+    """
+    Create a scratch DB in the given journal mode, preloaded with preload_rows readings.
+    """
+    da.db_journal_mode = mode
+    da.init_db(path)
+    conn = da.get_connection(path)
+    did = da.device_id(conn, meter, path)
+    da.insert_samples(conn, [(did, start_ts + i * step, i % 100 / 10) for i in range(preload_rows)], path)
+    conn.commit()
+    da.close_connections()
+
+
+def percentile(lat, p):
+    """
+    :return: p-th percentile of the latency list in ms
+    """
+    if not lat:
+        return 0.0
+    lat.sort()
+    return lat[min(len(lat) - 1, int(len(lat) * p / 100))] * 1000
+
+
+def configure(path, mode, busy_timeout):
+    da.ic2.disable()
+    da.db_name = path
+    da.db_journal_mode = mode
+    da.db_busy_timeout = busy_timeout
+
+
+def writer(path, mode, busy_timeout, seconds, out):
+    """
+    Commit one reading per call, as the manager does for every MQTT message.
+    """
+    configure(path, mode, busy_timeout)
+    lat, errors, i = [], 0, preload_rows
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        if da.add_IOT_data(meter, da.from_epoch(start_ts + i * step), str(i % 100 / 10)) is None:
+            errors += 1
+        lat.append(time.perf_counter() - t0)
+        i += 1
+    out.put(('writer', len(lat) - errors, errors, lat))
+
+
+def reader(path, mode, busy_timeout, seconds, out):
+    """
+    Query one day of readings per call, as GraphsDock.update_plot does.
+    """
+    configure(path, mode, busy_timeout)
+    lat, errors, n, day = [], 0, 0, 24 * 3600
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        first = start_ts + (n * 3600) % (preload_rows * step - day)
+        try:
+            da.filter_by_date('data', da.from_epoch(first), da.from_epoch(first + day), meter)
+        except sqlite3.OperationalError:
+            errors += 1
+        lat.append(time.perf_counter() - t0)
+        n += 1
+    out.put(('reader', len(lat) - errors, errors, lat))
+
+
+def run(mode, seconds, readers, busy_timeout):
+    """
+    :return: dict role -> (ops/s, p99 ms, max ms, errors)
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'bench_' + mode.lower() + '.db')
+    setup(path, mode)
+    ctx = mp.get_context('spawn')
+    out = ctx.Queue()
+    procs = [ctx.Process(target=writer, args=(path, mode, busy_timeout, seconds, out))]
+    procs += [ctx.Process(target=reader, args=(path, mode, busy_timeout, seconds, out)) for _ in range(readers)]
+    for p in procs:
+        p.start()
+    results = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    report = {}
+    for role in ('writer', 'reader'):
+        ok = sum(r[1] for r in results if r[0] == role)
+        errors = sum(r[2] for r in results if r[0] == role)
+        lat = [x for r in results if r[0] == role for x in r[3]]
+        report[role] = (ok / seconds, percentile(lat, 99), max(lat) * 1000 if lat else 0.0, errors)
+    return report
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    busy_timeout = int(sys.argv[3]) if len(sys.argv) > 3 else db_busy_timeout
+    da.ic2.disable()
+    print(f'{seconds:.0f}s, 1 writer, {readers} readers, busy_timeout {busy_timeout} ms')
+    print(f'{"mode":8}{"role":8}{"ops/s":>10}{"p99 ms":>10}{"max ms":>10}{"errors":>8}')
+    for mode in ('DELETE', 'WAL'):
+        for role, (rate, p99, worst, errors) in run(mode, seconds, readers, busy_timeout).items():
+            print(f'{mode:8}{role:8}{rate:10.0f}{p99:10.2f}{worst:10.2f}{errors:8d}')
@@ -0,0 +1,46 @@
+# Telemetry payload benchmark: messages/sec for each payload format
+# usage: python bench_payload.py [messages]
+# 'legacy split' is the chained split() parsing the manager and the GUI used before payload.py;
+# the other rows time payload.encode/decode as the emulators, the manager and the GUI use them.
+import sys
+import time
+import payload
+
+samples = [('dht', 'DHT-1', (25.0, 80.0)), ('meter', 'ElecMeter', (1.64, 0.018))]
+
+
+def legacy_split(m_decode):
+    """
+    The previous manager/GUI parsing of one text message.
+    """
+    if 'DHT' in m_decode:
+        return (m_decode.split('From: ')[1].split(' Temperature: ')[0],
+                float(m_decode.split(' Temperature: ')[1].split(' Humidity: ')[0]),
+                float(m_decode.split('Temperature: ')[1].split(' Humidity: ')[0]))
+    return (float(m_decode.split(' Electricity: ')[1].split(' Sensitivity: ')[0]),
+            float(m_decode.split(' Sensitivity: ')[1]),
+            float(m_decode.split('Electricity: ')[1].split(' Sensitivity: ')[0]))
+
+
+def rate(func, messages, n):
+    """
+    :return: calls per second of func over the messages, n calls in total
+    """
+    started = time.perf_counter()
+    for i in range(n):
+        func(messages[i % len(messages)])
+    return n / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print(f'{"format":14}{"bytes":>8}{"encode/s":>12}{"decode/s":>12}')
+    text = [payload.encode(kind, name, values, 'text').encode() for kind, name, values in samples]
+    size = sum(len(m) for m in text) / len(text)
+    print(f'{"legacy split":14}{size:8.0f}{"":>12}{rate(lambda m: legacy_split(m.decode()), text, n):12.0f}')
+    for fmt in ('text', 'json', 'struct'):
+        encoded = [payload.encode(kind, name, values, fmt) for kind, name, values in samples]
+        messages = [m if isinstance(m, bytes) else m.encode() for m in encoded]
+        size = sum(len(m) for m in messages) / len(messages)
+        enc = rate(lambda s: payload.encode(s[0], s[1], s[2], fmt), samples, n)
+        print(f'{fmt:14}{size:8.0f}{enc:12.0f}{rate(payload.decode, messages, n):12.0f}')
@@ -0,0 +1,96 @@
+# Coordinator of the sharded manager
+# usage: python coordinator.py [shards] [--spawn]
+# Collects the retained heartbeats of the manager shards and logs the partition assignment:
+# which shard owns which device topic, whether it is alive and how its ingest queue is doing.
+# With --spawn it also starts the shard processes (python manager.py --shard k/N) and stops
+# them when it exits.
+import os
+import sys
+import json
+import time
+import random
+import subprocess
+import paho.mqtt.client as mqtt
+from init import *
+from sharding import shard_of, shard_topic
+import data_acquisition as da
+from icecream import ic
+from datetime import datetime
+
+
+def time_format():
+    return f'{datetime.now()}  Coordinator|> '
+
+
+ic.configureOutput(prefix=time_format, includeContext=False)
+
+# shard -> last heartbeat
+shards_seen = {}
+# a shard beats at most once per manager cycle
+stale_after = 3 * max(shard_heartbeat_interval, manag_time + 3)
+
+
+def on_message(client, userdata, msg):
+    """Keep the latest heartbeat of every shard."""
+    try:
+        beat = json.loads(msg.payload)
+        shards_seen[beat['shard']] = beat
+    except (ValueError, KeyError, TypeError):
+        ic('Bad heartbeat on ' + msg.topic)
+
+
+def assignment(shards):
+    """
+    :return: report lines - one per shard (alive, load, devices) and the devices seen by a
+             shard that does not own them (e.g. after changing the shard count)
+    """
+    lines = []
+    now = time.time()
+    for shard in range(shards):
+        beat = shards_seen.get(shard)
+        if beat is None:
+            lines.append(f'shard {shard}/{shards}: no heartbeat')
+            continue
+        alive = beat['alive'] and now - beat['time'] < stale_after
+        stats = beat.get('stats', {})
+        lines.append(f'shard {shard}/{beat["shards"]}: {"alive" if alive else "DOWN"}, '
+                     f'queue {stats.get("depth", 0)}/{stats.get("capacity", 0)}, '
+                     f'processed {stats.get("processed", 0)}, dropped {stats.get("dropped", 0)}, '
+                     f'devices {sorted(beat["topics"])}')
+        for topic in beat['topics']:
+            if shard_of(topic, shards) != shard:
+                lines.append(f'  {topic} seen by shard {shard}, owned by shard {shard_of(topic, shards)}')
+    return lines
+
+
+def main(shards, spawn=False):
+    procs = []
+    if spawn:
+        da.init_db(db_name)  # migrate once, before the shards start
+        da.close_connections()
+        manager = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manager.py')
+        procs = [subprocess.Popen([sys.executable, manager, '--shard', f'{k}/{shards}']) for k in range(shards)]
+    client = mqtt.Client('Coordinator-' + str(random.randrange(1, 10000000)), clean_session=True)
+    client.on_message = on_message
+    if username != "":
+        client.username_pw_set(username, password)
+    client.connect(broker_ip, int(port))
+    client.subscribe(shard_topic + '+')
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(shard_heartbeat_interval)
+            for line in assignment(shards):
+                ic(line)
+    except KeyboardInterrupt:
+        ic('interrupted by keyboard')
+    client.loop_stop()
+    client.disconnect()
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    main(int(args[0]) if args else manager_shards, spawn='--spawn' in sys.argv)
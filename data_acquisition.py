@@ -1,6 +1,7 @@
 # data acqusition module
 import csv
-
+import io
+import os
 from os import name
 import pandas as pd
 from init import *
@@ -8,9 +9,17 @@ import sqlite3
 from sqlite3 import Error
 from datetime import datetime
 import time as tm
+import threading
+import atexit
+import calendar
+import functools
+import itertools
+from contextlib import contextmanager
 from icecream import ic as ic2
 import matplotlib.pyplot as plt
+import numpy as np
 import random
+import metrics
 
 
 # Set up icecream for logging with timestamps
@@ -39,6 +48,157 @@ def create_connection(db_file=db_name):
     return conn
 
 
+# Pool of long-lived connections shared by all data acquisition helpers
+class DBPool:
+    """
+    Keep one long-lived SQLite connection per (thread, database file).
+    A connection is opened the first time a thread asks for it and reused by every
+    later call from that thread, so sqlite3's prepared statement cache stays warm.
+    The database file defaults to db_name as it is at call time.
+    """
+
+    def __init__(self, stmt_cache=db_stmt_cache):
+        self.stmt_cache = stmt_cache
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+        self._generation = 0
+
+    def get(self, db_file=None):
+        """
+        Return the calling thread's connection to db_file, opening it on first use.
+        :param db_file: database file
+        :return: Connection object or None
+        """
+        db_file = db_file or db_name
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.conns = {}
+            local.generation = self._generation
+        conn = local.conns.get(db_file)
+        if conn is None:
+            conn = self._open(db_file)
+            if conn is not None:
+                local.conns[db_file] = conn
+        return conn
+
+    def _open(self, db_file):
+        conn = None
+        try:
+            # check_same_thread is off only so close_all() can run from the exit thread;
+            # get() never hands a connection to a thread other than its owner
+            conn = sqlite3.connect(db_file, timeout=db_busy_timeout / 1000, cached_statements=self.stmt_cache,
+                                   check_same_thread=False)
+            configure_connection(conn)
+        except Error as e:
+            ic2(e)
+            if conn is not None:
+                conn.close()
+            return None
+        with self._lock:
+            self._conns.append(conn)
+        ic2('Pooled connection opened: ' + db_file + ' (' + threading.current_thread().name + ')')
+        return conn
+
+    def release(self, db_file=None):
+        """
+        Close the calling thread's connection, e.g. before a worker thread exits.
+        :param db_file: database file
+        """
+        conns = getattr(self._local, 'conns', {})
+        conn = conns.pop(db_file or db_name, None)
+        if conn is not None:
+            with self._lock:
+                if conn in self._conns:
+                    self._conns.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        """
+        Close every pooled connection. Threads that keep running get a fresh
+        connection on their next call.
+        """
+        with self._lock:
+            conns, self._conns = self._conns, []
+            self._generation += 1
+        for conn in conns:
+            try:
+                conn.close()
+            except Error as e:
+                ic2(e)
+        if conns:
+            ic2('Closed ' + str(len(conns)) + ' pooled connection(s)')
+
+
+pool = DBPool()
+atexit.register(pool.close_all)
+
+
+def configure_connection(conn):
+    """
+    Apply the storage configuration (journal mode, lock timeout, durability, checkpoints) from init.py.
+    """
+    conn.execute('PRAGMA journal_mode=' + db_journal_mode)
+    conn.execute('PRAGMA busy_timeout=' + str(int(db_busy_timeout)))
+    conn.execute('PRAGMA synchronous=' + db_synchronous)
+    conn.execute('PRAGMA wal_autocheckpoint=' + str(int(db_wal_autocheckpoint)))
+
+
+def get_connection(db_file=None):
+    """
+    Get the pooled connection of the calling thread.
+    :param db_file: database file, db_name by default
+    :return: Connection object or None
+    """
+    return pool.get(db_file)
+
+
+# Consistent multi-query reads
+@contextmanager
+def read_snapshot(db_file=None):
+    """
+    Run several reads against one snapshot of the database. In WAL mode the
+    snapshot does not block the writer and does not see its later commits.
+    Helpers called inside the block (fetch_data, filter_by_date, ...) use the
+    same pooled connection and therefore the same snapshot.
+    usage: with read_snapshot(): ...
+    :return: the snapshot connection
+    """
+    conn = get_connection(db_file)
+    if conn is None:
+        raise Error('Cannot open the database connection: ' + (db_file or db_name))
+    if conn.in_transaction:
+        yield conn
+        return
+    attach_archives(conn, db_file)  # ATTACH is not allowed once the snapshot is open
+    conn.execute('BEGIN')
+    try:
+        conn.execute('SELECT 1 FROM sqlite_master LIMIT 1')  # pins the snapshot now, not at the first read
+        yield conn
+    finally:
+        conn.rollback()
+
+
+def checkpoint(db_file=None, mode='PASSIVE'):
+    """
+    Copy WAL content back into the database file.
+    :param mode: PASSIVE (never waits), FULL, RESTART or TRUNCATE (also shrinks the WAL file)
+    :return: tuple (busy, WAL frames, frames checkpointed)
+    """
+    conn = get_connection(db_file)
+    try:
+        return conn.execute('PRAGMA wal_checkpoint(' + mode + ')').fetchone()
+    except Error as e:
+        ic2(e)
+
+
+def close_connections():
+    """
+    Close all pooled connections (clean shutdown hook).
+    """
+    pool.close_all()
+
+
 # create a table
 def create_table(conn, create_table_sql):
     """
@@ -53,19 +213,121 @@ def create_table(conn, create_table_sql):
         ic2(e)
 
 
+# Schema of the time-series tables (version 6):
+# meters maps a meter/device name to an integer id, the readings are typed rows split into one
+# table per calendar month (samples_YYYYMM, see the partitions section below) with a composite
+# (device_id, ts) index, rollup_<name> keep min/max/sum/count/last per device and bucket for
+# every resolution in db_rollups, latest keeps the newest reading per device, and `data` stays
+# as a view with the version 1 columns so pandas readers and old INSERT INTO data statements
+# keep working.
+partition_table = """CREATE TABLE IF NOT EXISTS {schema}`{name}` (
+    `device_id` INTEGER NOT NULL,
+    `ts` INTEGER NOT NULL,
+    `value` REAL
+    );"""
+
+partition_index = """CREATE INDEX IF NOT EXISTS {schema}`{name}_device_ts` ON `{name}`(`device_id`, `ts`);"""
+
+rollup_table = """CREATE TABLE IF NOT EXISTS `rollup_{name}` (
+    `device_id` INTEGER NOT NULL,
+    `bucket` INTEGER NOT NULL,
+    `vmin` REAL,
+    `vmax` REAL,
+    `vsum` REAL,
+    `cnt` INTEGER,
+    `last_ts` INTEGER,
+    `vlast` REAL,
+    PRIMARY KEY(`device_id`, `bucket`)
+    ) WITHOUT ROWID;"""
+
+# merge a partial aggregate into a bucket; SET expressions all see the old row
+rollup_conflict = """ON CONFLICT(device_id, bucket) DO UPDATE SET
+    vmin = min(vmin, excluded.vmin), vmax = max(vmax, excluded.vmax),
+    vsum = vsum + excluded.vsum, cnt = cnt + excluded.cnt,
+    vlast = CASE WHEN excluded.last_ts >= last_ts THEN excluded.vlast ELSE vlast END,
+    last_ts = max(last_ts, excluded.last_ts)"""
+
+rollup_upsert = """INSERT INTO rollup_{name}(device_id, bucket, vmin, vmax, vsum, cnt, last_ts, vlast)
+    VALUES(?,?,?,?,?,?,?,?) """ + rollup_conflict
+
+# keep the newest reading; an older (late) reading never overwrites it
+latest_conflict = """ON CONFLICT(device_id) DO UPDATE SET ts = excluded.ts, value = excluded.value
+    WHERE excluded.ts >= latest.ts"""
+
+latest_upsert = """INSERT INTO latest(device_id, ts, value) VALUES(?,?,?) """ + latest_conflict
+
+data_tables = [
+    """CREATE TABLE IF NOT EXISTS `meters` (
+    `id` INTEGER PRIMARY KEY,
+    `name` TEXT NOT NULL UNIQUE
+    );""",
+    partition_table.format(schema='', name='samples_inbox'),
+    partition_index.format(schema='', name='samples_inbox'),
+    """CREATE TABLE IF NOT EXISTS `partitions` (
+    `name` TEXT PRIMARY KEY,
+    `start_ts` INTEGER NOT NULL,
+    `end_ts` INTEGER NOT NULL,
+    `archive` TEXT
+    );"""
+] + [rollup_table.format(name=name) for name in db_rollups] + [
+    """CREATE TABLE IF NOT EXISTS `latest` (
+    `device_id` INTEGER PRIMARY KEY,
+    `ts` INTEGER NOT NULL,
+    `value` REAL
+    ) WITHOUT ROWID;"""
+]
+
+# INSERT INTO data lands in samples_inbox; maintain_partitions() moves the rows to their month
+data_trigger = """CREATE TRIGGER IF NOT EXISTS `data_insert` INSTEAD OF INSERT ON `data`
+    BEGIN
+        INSERT OR IGNORE INTO meters(name) VALUES (NEW.name);
+        INSERT INTO samples_inbox(device_id, ts, value)
+        VALUES ((SELECT id FROM meters WHERE name = NEW.name), CAST(strftime('%s', NEW.timestamp) AS INTEGER), NEW.value);
+    """ + "".join("""    INSERT INTO rollup_{name}(device_id, bucket, vmin, vmax, vsum, cnt, last_ts, vlast)
+        SELECT device_id, ts / {size} * {size}, value, value, value, 1, ts, value FROM samples_inbox WHERE rowid = last_insert_rowid()
+        AND typeof(value) = 'real' {conflict};
+    """.format(name=name, size=size, conflict=rollup_conflict) for name, size in db_rollups.items()) + """    INSERT INTO latest(device_id, ts, value)
+        SELECT device_id, ts, value FROM samples_inbox WHERE rowid = last_insert_rowid() AND typeof(value) = 'real'
+        """ + latest_conflict + """;
+    END;"""
+
+
+# Device change log: a trigger appends one entry with a monotonic seq whenever a device row
+# is left with special = 'changed' (what update_IOT_dev does), and every consumer keeps its
+# own cursor, so each cycle reads only the entries after the cursor.
+change_tables = [
+    """CREATE TABLE IF NOT EXISTS `iot_changes` (
+    `seq` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `sys_id` INTEGER NOT NULL,
+    `changed_at` TEXT NOT NULL
+    );""",
+    """CREATE TABLE IF NOT EXISTS `change_cursors` (
+    `consumer` TEXT PRIMARY KEY,
+    `seq` INTEGER NOT NULL
+    );""",
+    """CREATE TRIGGER IF NOT EXISTS `iot_devices_changed` AFTER UPDATE ON `iot_devices`
+    WHEN NEW.special = 'changed'
+    BEGIN
+        INSERT INTO iot_changes(sys_id, changed_at) VALUES (NEW.sys_id, datetime('now', 'localtime'));
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS `iot_devices_created` AFTER INSERT ON `iot_devices`
+    WHEN NEW.special = 'changed'
+    BEGIN
+        INSERT INTO iot_changes(sys_id, changed_at) VALUES (NEW.sys_id, datetime('now', 'localtime'));
+    END;"""
+]
+
+
 # Initialize the database and tables
 def init_db(database):
     """
     Initialize the database with the required tables.
+    A version 1 database (text `data` table) is migrated in place to the current version,
+    older aggregates are backfilled and the samples table of a version 2-5 database is
+    split into monthly partitions.
     """
     # SQL statements for table creation
     tables = [
-        """ CREATE TABLE IF NOT EXISTS `data` (
-        `name` TEXT NOT NULL,
-        `timestamp` TEXT NOT NULL,
-        `value` TEXT NOT NULL,
-        FOREIGN KEY(`value`) REFERENCES `iot_devices`(`name`)
-        );""",
         """CREATE TABLE IF NOT EXISTS `iot_devices` (
         `sys_id` INTEGER PRIMARY KEY,
         `name` TEXT NOT NULL UNIQUE,
@@ -87,35 +349,665 @@ def init_db(database):
         ); """
     ]
     # Create a database connection
-    conn = create_connection(database)
+    conn = get_connection(database)
 
     # Create tables
     if conn is not None:
         for table in tables:
             create_table(conn, table)
-        conn.close()
+        new_log = not table_exists(conn, 'iot_changes')
+        for table in change_tables:
+            create_table(conn, table)
+        if new_log:
+            # devices still flagged by the old polling scheme become the first log entries
+            conn.execute("""INSERT INTO iot_changes(sys_id, changed_at)
+                SELECT sys_id, datetime('now', 'localtime') FROM iot_devices WHERE special = 'changed' ORDER BY sys_id""")
+        conn.commit()
+        version = schema_version(conn)
+        if version < 2 and table_exists(conn, 'data', 'table'):
+            migrate_db(database)
+            version = schema_version(conn)
+        if 1 < version < 6 and table_exists(conn, 'samples'):
+            # the unpartitioned table becomes the inbox and is drained into partitions below
+            conn.execute('DROP VIEW IF EXISTS data')
+            conn.execute('DROP INDEX IF EXISTS samples_device_ts')
+            conn.execute('ALTER TABLE `samples` RENAME TO `samples_inbox`')
+        for table in data_tables:
+            create_table(conn, table)
+        rebuild_data_view(conn)  # recreated with the current tables
+        if 0 < version < 3:
+            rebuild_rollups(conn, database)
+        if 0 < version < 4:
+            rebuild_latest(conn, database)
+        conn.execute('PRAGMA user_version=' + str(db_schema_version))
+        conn.commit()
+        if 0 < version < 6:
+            drain_inbox(conn, database)
     else:
         ic2("Error! Cannot create the database connection.")
 
 
+def schema_version(conn):
+    """
+    :return: PRAGMA user_version of the database
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def table_exists(conn, name, kind='table'):
+    """
+    :param kind: 'table', 'view', 'index' or 'trigger'
+    :return: True if the schema object exists
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type=? AND name=?", (kind, name)).fetchone() is not None
+
+
+# Migrate a version 1 database to the typed version 2 rows
+def migrate_db(database=db_name, vacuum=False):
+    """
+    Convert the text `data` table of a version 1 database into typed version 2 rows, in place.
+    Runs in one transaction, so an interrupted migration leaves the old table untouched.
+    The rows land in samples_inbox; init_db() builds the aggregates and partitions afterwards.
+    :param database: database file
+    :param vacuum: reclaim the space of the old table afterwards
+    :return: tuple (rows migrated, rows skipped because of an unreadable timestamp)
+    """
+    conn = create_connection(database)
+    if conn is None:
+        ic2("Error! Cannot create the database connection.")
+        return 0, 0
+    conn.isolation_level = None  # explicit BEGIN/COMMIT around DDL
+    conn.create_function('to_real', 1, to_real, deterministic=True)
+    try:
+        if schema_version(conn) >= 2 or not table_exists(conn, 'data', 'table'):
+            ic2('Nothing to migrate: ' + database)
+            return 0, 0
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('ALTER TABLE `data` RENAME TO `data_v1`')
+        total = conn.execute('SELECT count(*) FROM data_v1').fetchone()[0]
+        for table in data_tables[:2]:
+            conn.execute(table)
+        conn.execute('INSERT OR IGNORE INTO meters(name) SELECT DISTINCT name FROM data_v1')
+        # insert in index order and build the index afterwards - much faster than maintaining it row by row
+        moved = conn.execute("""INSERT INTO samples_inbox(device_id, ts, value)
+            SELECT m.id, CAST(strftime('%s', d.timestamp) AS INTEGER), to_real(d.value)
+            FROM data_v1 d JOIN meters m ON m.name = d.name
+            WHERE strftime('%s', d.timestamp) IS NOT NULL
+            ORDER BY m.id, d.timestamp""").rowcount
+        conn.execute(data_tables[2])
+        conn.execute('DROP TABLE data_v1')
+        conn.execute('PRAGMA user_version=2')
+        conn.execute('COMMIT')
+        ic2('Migrated ' + str(moved) + ' rows, skipped ' + str(total - moved) + ': ' + database)
+        if vacuum:
+            conn.execute('VACUUM')
+        return moved, total - moved
+    except Error as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        ic2(e)
+        return 0, 0
+    finally:
+        conn.close()
+
+
+# Time partitions of the readings
+# Every calendar month has its own table samples_YYYYMM, registered in `partitions` with its
+# [start_ts, end_ts) range, so a range query only reads the months it overlaps and old months
+# are dropped or moved as a whole. samples_inbox takes the rows that cannot go to their month
+# directly (INSERT INTO data through the view, late readings of an archived month, the samples
+# table of older databases); maintain_partitions() moves them on. Months older than
+# db_partition_hot_months are compacted into one archive file per year in db_archive_dir,
+# which is ATTACHed (SQLite allows 10 per connection) so queries still read them, and months
+# older than db_retention_months are deleted - the rollup tables keep their aggregates.
+@functools.lru_cache(maxsize=1024)
+def month_partition(year, month):
+    """
+    :return: tuple (partition table name, first ts, end ts - exclusive) of a calendar month
+    """
+    return ('samples_%04d%02d' % (year, month), calendar.timegm((year, month, 1, 0, 0, 0)),
+            calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0)))
+
+
+def partition_of(ts):
+    """
+    :return: month_partition() of the month holding epoch second ts
+    """
+    return month_partition(*tm.gmtime(ts)[:2])
+
+
+def months_back(ts, months):
+    """
+    :return: first ts of the month that is `months` calendar months before the month of ts
+    """
+    year, month = tm.gmtime(ts)[:2]
+    index = year * 12 + month - 1 - months
+    return month_partition(index // 12, index % 12 + 1)[1]
+
+
+# database file -> (PRAGMA schema_version, {name: (start_ts, end_ts, archive)}, names in time order)
+partition_registry = {}
+
+
+def load_partitions(conn, db_file=None):
+    """
+    Get the partition registry. It is cached per database file and read again only after a
+    schema change - creating, archiving or dropping a partition (in any process) changes
+    PRAGMA schema_version.
+    :return: tuple (dict name -> (start_ts, end_ts, archive file or None), names in time order)
+    """
+    db_file = db_file or db_name
+    version = conn.execute('PRAGMA schema_version').fetchone()[0]
+    cached = partition_registry.get(db_file)
+    if cached is None or cached[0] != version:
+        rows = conn.execute('SELECT name, start_ts, end_ts, archive FROM partitions ORDER BY start_ts').fetchall()
+        cached = partition_registry[db_file] = (version, {row[0]: row[1:] for row in rows}, [row[0] for row in rows])
+    return cached[1], cached[2]
+
+
+def archive_path(start_ts):
+    """
+    :return: archive for the partition starting at start_ts (one file per year), as stored in
+             `partitions`: relative to the database file's directory unless db_archive_dir is absolute
+    """
+    return os.path.join(db_archive_dir, 'samples_' + tm.strftime('%Y', tm.gmtime(start_ts)) + '.db')
+
+
+def archive_file(path, db_file=None):
+    """
+    Resolve an archive path of the registry against the database file's directory, so any
+    working directory finds it. Older versions stored paths relative to the working directory;
+    such a path is used as is when only it exists.
+    :return: file name of the archive
+    """
+    if os.path.isabs(path):
+        return path
+    resolved = os.path.join(os.path.dirname(os.path.abspath(db_file or db_name)), path)
+    return path if not os.path.exists(resolved) and os.path.exists(path) else resolved
+
+
+def attach_archive(conn, path, db_file=None):
+    """
+    ATTACH an archive file to the connection unless it is attached already.
+    Raises sqlite3 Error inside a transaction, where ATTACH is not allowed.
+    :return: schema name of the archive
+    """
+    alias = 'a_' + os.path.splitext(os.path.basename(path))[0]
+    if not any(row[1] == alias for row in conn.execute('PRAGMA database_list')):
+        conn.execute('ATTACH DATABASE ? AS ' + alias, (archive_file(path, db_file),))
+    return alias
+
+
+def attach_archives(conn, db_file=None):
+    """
+    ATTACH every archive in the registry, e.g. before starting a read transaction.
+    """
+    parts = load_partitions(conn, db_file)[0]
+    for path in sorted({archive for start, end, archive in parts.values() if archive is not None}):
+        attach_archive(conn, path, db_file)
+
+
+def partition_sources(conn, lo=None, hi=None, db_file=None):
+    """
+    Tables holding the readings between lo and hi (inclusive epoch seconds, None - open end):
+    the partitions overlapping the range in time order, then samples_inbox.
+    :return: list of table names, archived ones qualified with their schema
+    """
+    parts, names = load_partitions(conn, db_file)
+    sources = []
+    for name in names:
+        start, end, archive = parts[name]
+        if (hi is not None and start > hi) or (lo is not None and end <= lo):
+            continue
+        sources.append(name if archive is None else attach_archive(conn, archive, db_file) + '.' + name)
+    return sources + ['samples_inbox']
+
+
+def union_sql(select, sources, args=(), order=''):
+    """
+    Run one SELECT (with a {table} placeholder) over several partitions as a UNION ALL.
+    With an ORDER BY on an indexed column SQLite merges the ordered arms instead of sorting.
+    :return: tuple (sql, parameters)
+    """
+    return ' UNION ALL '.join(select.format(table=table) for table in sources) + order, list(args) * len(sources)
+
+
+def create_partition(conn, name, start_ts, end_ts):
+    """
+    Create a monthly partition, register it and add it to the data view, inside the
+    caller's transaction (one is started if needed, so the partition appears atomically).
+    """
+    if not conn.in_transaction:
+        conn.execute('BEGIN')
+    conn.execute(partition_table.format(schema='', name=name))
+    conn.execute(partition_index.format(schema='', name=name))
+    conn.execute('INSERT OR IGNORE INTO partitions(name, start_ts, end_ts) VALUES(?,?,?)', (name, start_ts, end_ts))
+    rebuild_data_view(conn)
+
+
+def rebuild_data_view(conn):
+    """
+    Recreate the `data` view (one arm per partition of the main database) and its INSERT trigger.
+    Archived partitions are not in the view, which cannot depend on ATTACHed files; the module's
+    readers of `data` go through partition_sources() instead.
+    """
+    tables = [row[0] for row in conn.execute('SELECT name FROM partitions WHERE archive IS NULL ORDER BY start_ts')]
+    # one join per arm, so a WHERE on the view is pushed down to each partition's index
+    arms = ["""SELECT m.name AS `name`, datetime(s.ts, 'unixepoch') AS `timestamp`, s.value AS `value`
+    FROM meters m CROSS JOIN `{table}` s ON s.device_id = m.id""".format(table=table) for table in tables + ['samples_inbox']]
+    conn.execute('DROP VIEW IF EXISTS `data`')  # drops data_insert as well
+    conn.execute('CREATE VIEW `data` AS\n    ' + '\n    UNION ALL\n    '.join(arms) + ';')
+    conn.execute(data_trigger)
+
+
+# Insert readings into their monthly partitions
+def insert_samples(conn, rows, db_file=None):
+    """
+    Insert readings into their monthly partitions, creating partitions as needed,
+    inside the caller's transaction. Readings of an archived month go to samples_inbox.
+    :param rows: iterable of (device_id, ts, value)
+    :return: row id of a single inserted reading (None for a batch)
+    """
+    lastrowid = None
+    months = {}
+    for row in rows:
+        months.setdefault(partition_of(row[1]), []).append(row)
+    for (name, start_ts, end_ts), part in months.items():
+        entry = load_partitions(conn, db_file)[0].get(name)
+        if entry is None:
+            create_partition(conn, name, start_ts, end_ts)
+        table = name if entry is None or entry[2] is None else 'samples_inbox'
+        sql = 'INSERT INTO `' + table + '`(device_id, ts, value) VALUES(?,?,?)'
+        if len(months) == 1 and len(part) == 1:
+            lastrowid = conn.execute(sql, part[0]).lastrowid
+        else:
+            conn.executemany(sql, part)
+    return lastrowid
+
+
+# Move samples_inbox rows into their partitions
+def drain_inbox(conn, db_file=None, chunk_size=db_import_chunk):
+    """
+    Move the rows of samples_inbox into their monthly partitions (archived months included),
+    one transaction per chunk_size rows.
+    :return: number of rows moved
+    """
+    moved = 0
+    try:
+        attach_archives(conn, db_file)
+        while True:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute('SELECT rowid, device_id, ts, value FROM samples_inbox ORDER BY rowid LIMIT ?',
+                                    (chunk_size,)).fetchall()
+                if not rows:
+                    return moved
+                months = {}
+                for row in rows:
+                    months.setdefault(partition_of(row[2]), []).append(row[1:])
+                for (name, start_ts, end_ts), part in months.items():
+                    entry = load_partitions(conn, db_file)[0].get(name)
+                    if entry is None:
+                        create_partition(conn, name, start_ts, end_ts)
+                    table = name if entry is None or entry[2] is None else attach_archive(conn, entry[2], db_file) + '.' + name
+                    conn.executemany('INSERT INTO ' + table + '(device_id, ts, value) VALUES(?,?,?)', part)
+                conn.execute('DELETE FROM samples_inbox WHERE rowid <= ?', (rows[-1][0],))
+            moved += len(rows)
+    except Error as e:
+        ic2(e)
+        return moved
+
+
+# Retention and archive compaction job
+def maintain_partitions(db_file=None, now=None):
+    """
+    Partition maintenance: drain samples_inbox, compact the months older than
+    db_partition_hot_months into the yearly archive files and delete the months older
+    than db_retention_months. Every step can be interrupted and simply runs again.
+    :param now: reference epoch seconds, the current time by default
+    :return: tuple (rows moved from the inbox, partitions archived, partitions deleted)
+    """
+    conn = get_connection(db_file)
+    if conn is None:
+        ic2("Error! Cannot create the database connection.")
+        return 0, 0, 0
+    moved = drain_inbox(conn, db_file)
+    now = to_epoch(timestamp()) if now is None else now
+    archived = deleted = 0
+    try:
+        parts, names = load_partitions(conn, db_file)
+        for name, (start_ts, end_ts, archive) in [(name, parts[name]) for name in names]:
+            if db_retention_months and end_ts <= months_back(now, db_retention_months):
+                drop_partition(conn, name, archive, db_file)
+                deleted += 1
+            elif archive is None and end_ts <= months_back(now, db_partition_hot_months):
+                archive_partition(conn, name, start_ts, db_file)
+                archived += 1
+    except Error as e:
+        ic2(e)
+    if archived or deleted:
+        ic2('Partitions archived: ' + str(archived) + ', deleted: ' + str(deleted))
+    return moved, archived, deleted
+
+
+def archive_partition(conn, name, start_ts, db_file=None):
+    """
+    Move a partition from the main database into its yearly archive file and compact the archive.
+    """
+    path = archive_path(start_ts)
+    os.makedirs(os.path.dirname(archive_file(path, db_file)), exist_ok=True)
+    alias = attach_archive(conn, path, db_file)
+    copy = 'INSERT INTO ' + alias + '.' + name + ' SELECT device_id, ts, value FROM `' + name + '` WHERE rowid {} ?'
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS ' + alias + '.' + name)  # left over by an interrupted run
+        conn.execute(partition_table.format(schema=alias + '.', name=name))
+        # written in index order, so the archived table and its index are dense
+        copied = conn.execute('SELECT coalesce(max(rowid), 0) FROM `' + name + '`').fetchone()[0]
+        conn.execute(copy.format('<=') + ' ORDER BY device_id, ts', (copied,))
+        conn.execute(partition_index.format(schema=alias + '.', name=name))
+    # a WAL transaction is atomic per file only: the copy is committed before the original goes.
+    # Rows written to the partition meanwhile (import_csv, a replay of old months) are copied under
+    # main's write lock, and the original is dropped once a locked check finds nothing left to copy.
+    while True:
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            newest = conn.execute('SELECT coalesce(max(rowid), 0) FROM `' + name + '`').fetchone()[0]
+            if newest == copied:
+                conn.execute('UPDATE partitions SET archive = ? WHERE name = ?', (path, name))
+                conn.execute('DROP TABLE `' + name + '`')
+                rebuild_data_view(conn)
+                break
+            conn.execute(copy.format('>'), (copied,))
+            copied = newest
+    conn.execute('VACUUM ' + alias)
+
+
+def drop_partition(conn, name, archive=None, db_file=None):
+    """
+    Delete a partition (retention). An archive file left without partitions is removed.
+    """
+    alias = attach_archive(conn, archive, db_file) if archive is not None else None
+    with conn:
+        conn.execute('BEGIN')
+        conn.execute('DROP TABLE IF EXISTS ' + (alias + '.' if alias else '') + '`' + name + '`')
+        conn.execute('DELETE FROM partitions WHERE name = ?', (name,))
+        rebuild_data_view(conn)  # also for an archive: the schema change invalidates cached registries
+    if alias is not None:
+        if conn.execute('SELECT 1 FROM partitions WHERE archive = ?', (archive,)).fetchone() is None:
+            conn.execute('DETACH DATABASE ' + alias)
+            try:
+                os.remove(archive_file(archive, db_file))
+            except OSError as e:  # still attached by another process
+                ic2(e)
+        else:
+            conn.execute('VACUUM ' + alias)
+
+
+# Rebuild the rollup tables from the partitions
+def rebuild_rollups(conn, db_file=None):
+    """
+    Recompute the rollup tables from the stored readings, inside the caller's transaction.
+    Buckets older than the oldest stored reading (removed by retention) are kept.
+    Partitions are aggregated one by one and merged with the rollup upsert.
+    """
+    sources = partition_sources(conn, db_file=db_file)
+    parts = load_partitions(conn, db_file)[0]
+    starts = [start for start, end, archive in parts.values()]
+    inbox_first = conn.execute('SELECT min(ts) FROM samples_inbox').fetchone()[0]
+    if inbox_first is not None:
+        starts.append(inbox_first)
+    if not starts:
+        return
+    for name, size in db_rollups.items():
+        conn.execute('DELETE FROM rollup_' + name + ' WHERE bucket >= ?', (min(starts) // size * size,))
+        for table in sources:
+            conn.execute("""INSERT INTO rollup_{name}(device_id, bucket, vmin, vmax, vsum, cnt, last_ts, vlast)
+                SELECT g.device_id, g.bucket, g.vmin, g.vmax, g.vsum, g.cnt, g.last_ts,
+                    (SELECT value FROM {table} s WHERE s.device_id = g.device_id AND s.ts = g.last_ts
+                     ORDER BY s.rowid DESC LIMIT 1)
+                FROM (SELECT device_id, ts / {size} * {size} AS bucket, min(value) AS vmin, max(value) AS vmax,
+                      sum(value) AS vsum, count(value) AS cnt, max(ts) AS last_ts
+                      FROM {table} WHERE value IS NOT NULL GROUP BY device_id, bucket) g WHERE true
+                """.format(name=name, size=size, table=table) + rollup_conflict)
+
+
+# Fold new readings into the rollup tables
+def update_rollups(conn, rows):
+    """
+    Incrementally add readings to every rollup table, inside the caller's transaction.
+    Readings are pre-aggregated per bucket, so a batch costs one upsert per touched bucket.
+    :param rows: iterable of (device_id, ts, value); None values are skipped
+    """
+    rows = [row for row in rows if row[2] is not None]
+    if not rows:
+        return
+    for name, size in db_rollups.items():
+        buckets = {}
+        for did, ts, value in rows:
+            key = (did, ts // size * size)
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [value, value, value, 1, ts, value]
+            else:
+                if value < agg[0]:
+                    agg[0] = value
+                if value > agg[1]:
+                    agg[1] = value
+                agg[2] += value
+                agg[3] += 1
+                if ts >= agg[4]:
+                    agg[4] = ts
+                    agg[5] = value
+        conn.executemany(rollup_upsert.format(name=name), [key + tuple(agg) for key, agg in buckets.items()])
+
+
+# Rebuild the latest table from the partitions
+def rebuild_latest(conn, db_file=None):
+    """
+    Recompute the newest reading of every device, inside the caller's transaction.
+    """
+    sources = partition_sources(conn, db_file=db_file)
+    conn.execute('DELETE FROM latest')
+    # a bare column next to a single max() comes from the row holding the maximum
+    for table in sources:
+        conn.execute("""INSERT INTO latest(device_id, ts, value)
+            SELECT device_id, max(ts), value FROM {table} WHERE value IS NOT NULL GROUP BY device_id
+            """.format(table=table) + latest_conflict)
+
+
+# Newest reading per device in the latest table
+def update_latest(conn, rows):
+    """
+    Record the newest reading per device in the latest table, inside the caller's transaction.
+    :param rows: iterable of (device_id, ts, value); None values are skipped
+    """
+    newest = {}
+    for did, ts, value in rows:
+        if value is not None and (did not in newest or ts >= newest[did][0]):
+            newest[did] = (ts, value)
+    if newest:
+        conn.executemany(latest_upsert, [(did, ts, value) for did, (ts, value) in newest.items()])
+
+
+# Newest reading per (database file, meter name), kept in memory by the writing process
+latest_values = {}
+
+
+def cache_latest(name, ts, value, db_file=None):
+    """
+    Remember a reading in latest_values if it is the newest one seen for the meter.
+    """
+    if value is None:
+        return
+    key = (db_file or db_name, name)
+    cached = latest_values.get(key)
+    if cached is None or ts >= cached[0]:
+        latest_values[key] = (ts, value)
+
+
+# Newest reading of a meter in O(1)
+def get_latest(name, db_file=None):
+    """
+    Get the newest reading of a meter. The writing process answers from memory
+    (including rows still in the write buffer); other processes (GUI, assistant)
+    read one row of the latest table.
+    :param name: Meter name
+    :return: tuple (timestamp, value) or None if the meter has no readings
+    """
+    db_file = db_file or db_name
+    cached = latest_values.get((db_file, name))
+    if cached is None:
+        conn = get_connection(db_file)
+        if conn is None:
+            ic2("Error! Cannot create the database connection.")
+            return None
+        cached = conn.execute('SELECT l.ts, l.value FROM meters m CROSS JOIN latest l ON l.device_id = m.id'
+                              ' WHERE m.name = ?', (name,)).fetchone()
+        if cached is None:
+            return None
+    return from_epoch(cached[0]), cached[1]
+
+
 # Acquire data from CSV and load into the database
 def csv_acq_data(table_name):
     """
     Load data from CSV into the specified table.
     :param table_name: Name of the table to load data into
     """
-    conn = create_connection(db_name)
+    conn = get_connection(db_name)
     try:
-        if db_init:
-            data = pd.read_csv("data/SafeSleepData.csv")
+        if db_init and table_name == 'data':
+            import_csv(csv_data_file)
+        elif db_init:
+            data = pd.read_csv(csv_data_file)
             data.to_sql(table_name, conn, if_exists='append', index=False)
+        elif table_name == 'data':
+            data = fetch_table_data_into_df(table_name, conn, '%')  # archived partitions included
         else:
             data = pd.read_sql_query("SELECT * FROM " + table_name, conn)
     except Error as e:
         ic2(e)
-    finally:
-        if conn:
-            conn.close()
+
+
+
+# Streaming, resumable CSV importer for the data table
+def import_csv(csv_file=csv_data_file, chunk_size=db_import_chunk, drop_indexes=False, resume=True):
+    """
+    Import a name,timestamp,value CSV export into the monthly partitions chunk by chunk.
+    Every chunk is converted to the table types and written in one transaction together
+    with its progress record (rows and byte offset), so an interrupted import seeks past the
+    last committed chunk without duplicates. Rows with an unreadable timestamp are skipped.
+    Chunks are cut at line ends: quoted values must not contain newlines.
+    :param csv_file: CSV file path
+    :param chunk_size: rows per chunk/transaction
+    :param drop_indexes: drop the partition indexes during the import and rebuild them (and the
+                         rollup and latest tables) once at the end - fastest for big imports
+    :param resume: continue an interrupted import of the same, unchanged file
+    :return: tuple (rows imported, rows skipped)
+    """
+    conn = get_connection()
+    if conn is None:
+        ic2("Error! Cannot create the database connection.")
+        return 0, 0
+    conn.execute("""CREATE TABLE IF NOT EXISTS `import_progress` (
+        `source` TEXT PRIMARY KEY,
+        `size` INTEGER,
+        `mtime` INTEGER,
+        `rows_done` INTEGER,
+        `complete` INTEGER,
+        `updated` TEXT,
+        `offset` INTEGER
+        )""")
+    if not any(row[1] == 'offset' for row in conn.execute('PRAGMA table_info(import_progress)')):
+        conn.execute('ALTER TABLE import_progress ADD COLUMN `offset` INTEGER')  # progress of older versions
+    conn.commit()
+    source = os.path.abspath(csv_file)
+    size, mtime = os.path.getsize(source), int(os.path.getmtime(source))
+    rows_done, offset = 0, None
+    progress = conn.execute('SELECT size, mtime, rows_done, complete, offset FROM import_progress WHERE source = ?',
+                            (source,)).fetchone()
+    if resume and progress is not None and progress[:2] == (size, mtime):
+        if progress[3]:
+            ic2('Already imported: ' + source)
+            return 0, 0
+        rows_done, offset = progress[2], progress[4]
+        ic2('Resuming ' + source + ' after row ' + str(rows_done))
+        # an interrupted bulk import left the aggregates for the final rebuild
+        drop_indexes = drop_indexes or not table_exists(conn, 'samples_inbox_device_ts', 'index')
+    if drop_indexes:
+        for table in ['samples_inbox'] + load_partitions(conn)[1]:
+            conn.execute('DROP INDEX IF EXISTS `' + table + '_device_ts`')
+        conn.commit()
+    progress_sql = """INSERT INTO import_progress(source, size, mtime, rows_done, complete, updated, offset)
+        VALUES(?,?,?,?,?,?,?)
+        ON CONFLICT(source) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, rows_done = excluded.rows_done,
+        complete = excluded.complete, updated = excluded.updated, offset = excluded.offset"""
+    imported = skipped = 0
+    started = tm.perf_counter()
+    for chunk, lines, offset in csv_chunks(source, chunk_size, rows_done, offset):
+        # fast path for the timestamp() format, then per-value parsing of whatever is left
+        stamps = pd.to_datetime(chunk['timestamp'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+        odd = stamps.isna() & chunk['timestamp'].notna()
+        if odd.any():
+            stamps[odd] = [pd.to_datetime(stamp, errors='coerce') for stamp in chunk['timestamp'][odd]]
+        good = stamps.notna().to_numpy()
+        ts = stamps[good].to_numpy().astype('datetime64[s]').astype(np.int64)
+        values = pd.to_numeric(chunk['value'][good], errors='coerce').to_numpy()
+        names = chunk['name'][good].to_numpy()
+        try:
+            with conn:
+                ids = {name: device_id(conn, name) for name in set(names)}
+                rows = [(ids[name], int(t), None if v != v else float(v)) for name, t, v in zip(names, ts, values)]
+                insert_samples(conn, rows)
+                if drop_indexes:
+                    # partitions created by this chunk start without an index as well
+                    for table in load_partitions(conn)[1]:
+                        conn.execute('DROP INDEX IF EXISTS `' + table + '_device_ts`')
+                else:
+                    update_rollups(conn, rows)
+                    update_latest(conn, rows)
+                rows_done += lines
+                conn.execute(progress_sql, (source, size, mtime, rows_done, 0, timestamp(), offset))
+        except Error as e:
+            device_ids.clear()
+            ic2(e)
+            return imported, skipped
+        imported += len(rows)
+        skipped += len(chunk) - len(rows)
+        ic2(f'{source}: {rows_done} rows, {imported / (tm.perf_counter() - started):.0f} rows/s')
+    with conn:
+        if drop_indexes:
+            ic2('Rebuilding indexes and aggregates')
+            for table in ['samples_inbox'] + load_partitions(conn)[1]:
+                if load_partitions(conn)[0].get(table, (0, 0, None))[2] is None:
+                    conn.execute(partition_index.format(schema='', name=table))
+            rebuild_rollups(conn)
+            rebuild_latest(conn)
+        conn.execute(progress_sql, (source, size, mtime, rows_done, 1, timestamp(), offset))
+    ic2(f'Imported {imported} rows, skipped {skipped}, {imported / (tm.perf_counter() - started):.0f} rows/s')
+    return imported, skipped
+
+
+def csv_chunks(source, chunk_size, rows_done=0, offset=None):
+    """
+    Read a CSV file in chunks of chunk_size lines, starting at a byte offset (or, for progress
+    recorded without one, after rows_done lines, which are skipped without being parsed).
+    :return: iterator over (DataFrame, lines read, byte offset after the chunk)
+    """
+    with open(source, 'rb') as f:
+        columns = pd.read_csv(io.BytesIO(f.readline()), nrows=0).columns
+        if offset:
+            f.seek(offset)
+        else:
+            for _ in itertools.islice(f, rows_done):
+                pass
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                return
+            chunk = pd.read_csv(io.BytesIO(b''.join(lines)), header=None, names=columns,
+                                dtype={'name': str, 'timestamp': str, 'value': str})
+            yield chunk, len(lines), f.tell()
 
         # Create a new IoT device record in the database
 
@@ -128,42 +1020,221 @@ def create_IOT_dev(name, status, units, last_updated, update_interval, SafeSleep
     """
     sql = ''' INSERT INTO iot_devices(name, status, units, last_updated, update_interval, SafeSleepCardId, placed, dev_type, enabled, state, mode, fan, temperature, dev_pub_topic, dev_sub_topic, special)
               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) '''
-    conn = create_connection()
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
         cur.execute(sql,
                     [name, status, units, last_updated, update_interval, SafeSleepCardId, placed, dev_type, enabled,
                      state, mode, fan, temperature, dev_pub_topic, dev_sub_topic, special])
         conn.commit()
-        re = cur.lastrowid
-        conn.close()
-        return re
+        return cur.lastrowid
     else:
         ic2("Error! Cannot create the database connection.")
 
     # Generate a timestamp in the required format
 
 
-def timestamp():
-    return str(datetime.fromtimestamp(datetime.timestamp(datetime.now()))).split('.')[0]
+def timestamp(ts=None):
+    """
+    :param ts: epoch sec, None for now
+    :return: 'YYYY-MM-DD HH:MM:SS' local wall-clock time
+    """
+    return str(datetime.fromtimestamp(datetime.timestamp(datetime.now()) if ts is None else ts)).split('.')[0]
+
+
+# Convert a timestamp string to the integer ts column
+def to_epoch(stamp):
+    """
+    Convert a 'YYYY-MM-DD[ HH:MM:SS]' timestamp to integer epoch seconds.
+    Timestamps are naive wall-clock strings, so they are read as UTC - the same
+    convention as SQLite's strftime('%s') and datetime(ts, 'unixepoch').
+    :return: epoch seconds (int)
+    """
+    if isinstance(stamp, (int, float)):
+        return int(stamp)
+    if not isinstance(stamp, datetime):
+        stamp = datetime.fromisoformat(str(stamp).strip())
+    return calendar.timegm(stamp.timetuple())
+
+
+def from_epoch(ts):
+    """
+    Convert epoch seconds back to the 'YYYY-MM-DD HH:MM:SS' timestamp format.
+    """
+    return tm.strftime('%Y-%m-%d %H:%M:%S', tm.gmtime(ts))
+
+
+def to_real(value):
+    """
+    Convert a reading to float, None if it is not numeric.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# name -> meters.id cache, keyed by database file
+device_ids = {}
+
+
+def device_id(conn, name, db_file=None, create=True):
+    """
+    Get the integer id of a meter/device name, registering the name if it is new.
+    The insert joins the caller's transaction.
+    :return: meters.id or None
+    """
+    key = (db_file or db_name, name)
+    did = device_ids.get(key)
+    if did is None:
+        if create:
+            conn.execute('INSERT OR IGNORE INTO meters(name) VALUES(?)', (name,))
+        row = conn.execute('SELECT id FROM meters WHERE name=?', (name,)).fetchone()
+        if row is None:
+            return None
+        did = device_ids[key] = row[0]
+    return did
+
+
+# Write transaction latency (insert + rollups + commit) and rows written, see metrics.py
+db_commit_seconds = metrics.registry.histogram('db_commit_seconds', 'Duration of one data write transaction incl. commit')
+db_rows_written = metrics.registry.counter('db_rows_written', 'Readings written to the data tables')
+
+
+# Write-behind buffer for the data table
+class WriteBuffer:
+    """
+    Collect data rows in memory and write them with a single executemany
+    transaction (one commit, one fsync) once db_batch_size rows are waiting
+    or the oldest row is db_batch_age seconds old.
+    """
+
+    def __init__(self, db_file=None, max_rows=db_batch_size, max_age=db_batch_age):
+        self.db_file = db_file
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.rows = []
+        self.first_added = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def add(self, name, updated, value):
+        """
+        Buffer one row and flush if the size or age limit is reached.
+        """
+        if self._flusher is None:
+            self.start()
+        with self._lock:
+            if not self.rows:
+                self.first_added = tm.monotonic()
+            # convert now, so a bad timestamp fails in the caller rather than in the flush
+            row = (name, to_epoch(updated), to_real(value))
+            self.rows.append(row)
+            full = len(self.rows) >= self.max_rows or tm.monotonic() - self.first_added >= self.max_age
+        cache_latest(*row, db_file=self.db_file)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows in one transaction.
+        :return: number of rows written
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return 0
+            conn = get_connection(self.db_file)
+            try:
+                with db_commit_seconds.time(), conn:
+                    samples = [(device_id(conn, name, self.db_file), ts, value) for name, ts, value in rows]
+                    insert_samples(conn, samples, self.db_file)
+                    update_rollups(conn, samples)
+                    update_latest(conn, samples)
+            except Error as e:
+                ic2(e)
+                device_ids.clear()
+                # keep the rows for the next flush instead of losing them
+                with self._lock:
+                    self.rows[:0] = rows
+                    self.first_added = tm.monotonic()
+                return 0
+            db_rows_written.inc(len(rows))
+            return len(rows)
+
+    def start(self):
+        """
+        Start the background thread that flushes rows older than max_age when traffic stops.
+        """
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._run, name='db-write-buffer', daemon=True)
+        self._flusher.start()
+
+    def _run(self):
+        while not self._stop.wait(self.max_age):
+            with self._lock:
+                stale = self.rows and tm.monotonic() - self.first_added >= self.max_age
+            if stale:
+                self.flush()
+        pool.release(self.db_file)
+
+    def stop(self):
+        """
+        Stop the flusher thread and write what is left (shutdown hook).
+        """
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        return self.flush()
+
+
+write_buffer = WriteBuffer()
+# registered after the pool, so it runs before the pool closes (atexit is LIFO)
+atexit.register(write_buffer.stop)
+
+
+def flush_IOT_data():
+    """
+    Flush the write-behind buffer and stop its flusher thread.
+    :return: number of rows written
+    """
+    return write_buffer.stop()
 
 
 # Add data entry for an IoT device
 def add_IOT_data(name, updated, value):
     """
     Add new IoT device data into the data table.
-    :return: last row id of the inserted data
+    With db_write_buffered the row is queued for the next group commit.
+    :return: last row id of the inserted data (None when buffered)
     """
-    sql = ''' INSERT INTO data(name, timestamp, value)
-              VALUES(?,?,?) '''
-    conn = create_connection()
+    if db_write_buffered:
+        write_buffer.add(name, updated, value)
+        return None
+    conn = get_connection()
     if conn is not None:
-        cur = conn.cursor()
-        cur.execute(sql, [name, updated, value])
-        conn.commit()
-        re = cur.lastrowid
-        conn.close()
-        return re
+        try:
+            with db_commit_seconds.time():
+                row = (device_id(conn, name), to_epoch(updated), to_real(value))
+                lastrowid = insert_samples(conn, [row])
+                update_rollups(conn, [row])
+                update_latest(conn, [row])
+                conn.commit()
+        except Error as e:
+            conn.rollback()
+            device_ids.clear()
+            ic2(e)
+            return None
+        db_rows_written.inc()
+        cache_latest(name, row[1], row[2])
+        return lastrowid
     else:
         ic2("Error! Cannot create the database connection.")
 
@@ -177,15 +1248,45 @@ def read_IOT_data(table, name):
     :param name: Name of the IoT device
     :return: Rows list selected by name
     """
-    conn = create_connection()
+    return list(iter_IOT_data(table, name))
+
+
+# Stream the rows of an IoT device
+def iter_IOT_data(table, name, chunk_size=db_chunk_size):
+    """
+    Generator variant of read_IOT_data: rows are fetched chunk_size at a time.
+    :param table: Table name to query
+    :param name: Name of the IoT device
+    :return: iterator over the rows selected by name
+    """
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM " + table + " WHERE name=?", (name,))
-        rows = cur.fetchall()
-        return rows
+        if table == 'data':
+            cur.execute(*union_sql(data_select + " WHERE m.name=?", partition_sources(conn), (name,)))
+        else:
+            cur.execute("SELECT * FROM " + table + " WHERE name=?", (name,))
+        yield from iter_cursor(cur, chunk_size)
     else:
         ic2("Error! Cannot create the database connection.")
 
+
+def iter_cursor(cur, chunk_size=db_chunk_size):
+    """
+    Yield the rows of an executed cursor, holding at most chunk_size of them in memory.
+    The statement stays open (and keeps its read snapshot) until the generator is
+    exhausted or closed, so consume it promptly and in the thread that created it.
+    """
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+
     # Update the temperature of a specific IoT device
 
 
@@ -194,12 +1295,11 @@ def update_IOT_dev(tem_p):
     Update temperature of an IoT device by name.
     """
     sql = ''' UPDATE iot_devices SET temperature = ?, special = 'changed' WHERE name = ?'''
-    conn = create_connection()
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
         cur.execute(sql, tem_p)
         conn.commit()
-        conn.close()
     else:
         ic2("Error! Cannot create the database connection.")
 
@@ -211,12 +1311,11 @@ def update_IOT_status(iot_dev):
     Update the special status of an IoT device by sys_id.
     """
     sql = ''' UPDATE iot_devices SET special = 'done' WHERE sys_id = ?'''
-    conn = create_connection()
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
         cur.execute(sql, (int(iot_dev),))
         conn.commit()
-        conn.close()
     else:
         ic2("Error! Cannot create the database connection.")
 
@@ -228,7 +1327,7 @@ def check_changes(table):
     Check for changes in the IoT devices table.
     :return: Rows with 'changed' status
     """
-    conn = create_connection()
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
         cur.execute("SELECT * FROM " + table + " WHERE special=?", ('changed',))
@@ -237,18 +1336,82 @@ def check_changes(table):
     else:
         ic2("Error! Cannot create the database connection.")
 
+    # Read new entries of the device change log
+
+
+def read_changes(consumer='manager', limit=db_change_batch):
+    """
+    Read the device changes after the consumer's cursor, oldest first.
+    Call ack_changes() with each processed seq to move the cursor.
+    :param consumer: cursor name
+    :param limit: max number of changes
+    :return: rows (seq, sys_id, name, state, temperature, dev_sub_topic) with the device's current values
+    """
+    conn = get_connection()
+    if conn is not None:
+        cur = conn.cursor()
+        cur.execute("""SELECT c.seq, d.sys_id, d.name, d.state, d.temperature, d.dev_sub_topic
+            FROM iot_changes c JOIN iot_devices d ON d.sys_id = c.sys_id
+            WHERE c.seq > ifnull((SELECT seq FROM change_cursors WHERE consumer = ?), 0)
+            ORDER BY c.seq LIMIT ?""", (consumer, limit))
+        return cur.fetchall()
+    else:
+        ic2("Error! Cannot create the database connection.")
+        return []
+
+
+def ack_changes(seq, consumer='manager'):
+    """
+    Persist the consumer's cursor: changes up to seq are processed and never read again.
+    """
+    conn = get_connection()
+    if conn is not None:
+        conn.execute("""INSERT INTO change_cursors(consumer, seq) VALUES(?,?)
+            ON CONFLICT(consumer) DO UPDATE SET seq = max(seq, excluded.seq)""", (consumer, seq))
+        conn.commit()
+    else:
+        ic2("Error! Cannot create the database connection.")
+
+
+def prune_changes():
+    """
+    Delete log entries that every consumer has already processed.
+    :return: number of deleted entries
+    """
+    conn = get_connection()
+    if conn is not None:
+        cur = conn.execute("DELETE FROM iot_changes WHERE seq <= (SELECT min(seq) FROM change_cursors)")
+        conn.commit()
+        return cur.rowcount
+    else:
+        ic2("Error! Cannot create the database connection.")
+        return 0
+
     # Fetch data from a table into a DataFrame with filtering
 
 
-def fetch_table_data_into_df(table_name, conn, filter):
+def fetch_table_data_into_df(table_name, conn, filter, db_file=None):
     """
     Fetch data from a table into a DataFrame.
+    The `data` view holds the main database's partitions only; its rows are read from every
+    partition, archived ones included (as iter_IOT_data does).
     :param table_name: Name of the table
     :param conn: Database connection
     :param filter: Filter condition for data
+    :param db_file: database file of conn, db_name by default
     :return: DataFrame of filtered data
     """
-    return pd.read_sql_query("SELECT * from " + table_name + " WHERE `name` LIKE " + "'" + filter + "'", conn)
+    if table_name == 'data':
+        sql, params = union_sql(data_select + " WHERE m.name LIKE ?", partition_sources(conn, db_file=db_file),
+                                (filter,))
+        return pd.read_sql_query(sql, conn, params=params)
+    return pd.read_sql_query("SELECT * from " + table_name + " WHERE `name` LIKE ?", conn, params=(filter,))
+
+
+# Rows of the `data` view read straight from one partition ({table}, see union_sql); CROSS JOIN keeps
+# meters as the outer loop so the (device_id, ts) index is used even without ANALYZE statistics
+data_select = ("SELECT m.name AS `name`, datetime(s.ts, 'unixepoch') AS `timestamp`, s.value AS `value` "
+               "FROM meters m CROSS JOIN {table} s ON s.device_id = m.id")
 
 
 # Filter data by date range for a specific meter
@@ -261,16 +1424,178 @@ def filter_by_date(table_name, start_date, end_date, meter):
     :param meter: Meter name to filter
     :return: Filtered rows
     """
-    conn = create_connection()
+    return list(iter_by_date(table_name, start_date, end_date, meter))
+
+
+# Stream data between dates for a specific meter
+def iter_by_date(table_name, start_date, end_date, meter, chunk_size=db_chunk_size):
+    """
+    Generator variant of filter_by_date: scans any range at constant memory and
+    reads only the monthly partitions overlapping it.
+    :param table_name: Name of the table
+    :param start_date: Start date for filtering
+    :param end_date: End date for filtering
+    :param meter: Meter name to filter
+    :return: iterator over the filtered rows
+    """
+    conn = get_connection()
     if conn is not None:
         cur = conn.cursor()
-        cur.execute(
-            "SELECT * FROM " + table_name + " WHERE `name` LIKE '" + meter + "' AND timestamp BETWEEN '" + start_date + "' AND '" + end_date + "'")
-        rows = cur.fetchall()
-        return rows
+        if table_name == 'data':
+            lo, hi = to_epoch(start_date), to_epoch(end_date)
+            cur.execute(*union_sql(data_select + " WHERE m.name LIKE ? AND s.ts BETWEEN ? AND ?",
+                                   partition_sources(conn, lo, hi), (meter, lo, hi)))
+        else:
+            cur.execute("SELECT * FROM " + table_name + " WHERE `name` LIKE ? AND timestamp BETWEEN ? AND ?",
+                        (meter, start_date, end_date))
+        yield from iter_cursor(cur, chunk_size)
     else:
         ic2("Error! Cannot create the database connection.")
 
+
+# Stream a meter's readings as NumPy column blocks
+def iter_blocks_by_date(meter, start_date, end_date, chunk_size=db_chunk_size):
+    """
+    Yield the readings of one meter between dates as NumPy column blocks in time order.
+    Only one block of chunk_size readings is alive at a time; NULL readings are skipped.
+    usage: for ts, value in iter_blocks_by_date('ElectricityMeter', '2021-05-01', '2021-06-01'): ...
+    :param meter: Meter name
+    :return: iterator over (ts int64 epoch seconds, value float64) array pairs
+    """
+    conn = get_connection()
+    if conn is None:
+        ic2("Error! Cannot create the database connection.")
+        return
+    did = device_id(conn, meter, create=False)
+    if did is None:
+        return
+    lo, hi = to_epoch(start_date), to_epoch(end_date)
+    cur = conn.cursor()
+    cur.execute(*union_sql("SELECT ts, value FROM {table} WHERE device_id = ? AND ts BETWEEN ? AND ? AND value IS NOT NULL",
+                           partition_sources(conn, lo, hi), (did, lo, hi), " ORDER BY ts"))
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            block = np.array(rows, dtype=[('ts', np.int64), ('value', np.float64)])
+            yield block['ts'], block['value']
+    finally:
+        cur.close()
+
+
+    # Rollup resolution covering a date range
+
+
+def rollup_resolution(start_ts, end_ts, max_points=rollup_max_points):
+    """
+    Choose the rollup for a range: the finest resolution that needs at most max_points
+    buckets, or the coarsest one when even that needs more.
+    :return: (rollup name, bucket size in sec)
+    """
+    sizes = sorted(db_rollups.items(), key=lambda item: item[1])
+    for name, size in sizes:
+        if (end_ts - start_ts) // size + 1 <= max_points:
+            return name, size
+    return sizes[-1]
+
+
+# Aggregated readings of a meter between dates
+def query_rollup(meter, start_date, end_date, max_points=rollup_max_points, resolution=None):
+    """
+    Read per-bucket aggregates of a meter from the rollup tables.
+    :param meter: Meter name (LIKE pattern) to filter
+    :param resolution: rollup name from db_rollups; chosen by rollup_resolution() when None
+    :return: rows (name, bucket timestamp, min, max, average, count, last) ordered by name and time
+    """
+    start_ts, end_ts = to_epoch(start_date), to_epoch(end_date)
+    if resolution is None:
+        resolution = rollup_resolution(start_ts, end_ts, max_points)[0]
+    conn = get_connection()
+    if conn is not None:
+        cur = conn.cursor()
+        cur.execute("SELECT m.name, datetime(r.bucket, 'unixepoch'), r.vmin, r.vmax, r.vsum / r.cnt, r.cnt, r.vlast"
+                    " FROM meters m CROSS JOIN rollup_" + resolution + " r ON r.device_id = m.id"
+                    " WHERE m.name LIKE ? AND r.bucket BETWEEN ? AND ? ORDER BY m.name, r.bucket",
+                    (meter, start_ts - start_ts % db_rollups[resolution], end_ts))
+        return cur.fetchall()
+    else:
+        ic2("Error! Cannot create the database connection.")
+
+
+def cover_range(lo, hi, sizes):
+    """
+    Split the half-open range [lo, hi) into bucket-aligned pieces, coarsest first.
+    :param sizes: rollup (name, size) pairs ordered from coarsest to finest
+    :return: (pieces as (rollup name, first bucket, end), raw leftovers as (lo, hi))
+    """
+    if lo >= hi:
+        return [], []
+    if not sizes:
+        return [], [(lo, hi)]
+    name, size = sizes[0]
+    first, end = -(-lo // size) * size, hi // size * size
+    if first >= end:
+        return cover_range(lo, hi, sizes[1:])
+    left, left_raw = cover_range(lo, first, sizes[1:])
+    right, right_raw = cover_range(end, hi, sizes[1:])
+    return [(name, first, end)] + left + right, left_raw + right_raw
+
+
+# Exact aggregate of a meter over a date range
+def rollup_stats(meter, start_date=None, end_date=None):
+    """
+    Compute min/max/average/count/last of a meter. The range is covered by whole
+    day, hour and minute buckets and only the unaligned edges read raw samples,
+    so the result is exact at the cost of a few hundred rows at most.
+    Without dates the whole history is aggregated from the coarsest rollup.
+    :param meter: Meter name
+    :return: tuple (min, max, average, count, last) - all None when there is no data
+    """
+    conn = get_connection()
+    if conn is None:
+        ic2("Error! Cannot create the database connection.")
+        return None
+    did = device_id(conn, meter, create=False)
+    parts = []
+    if did is not None:
+        sizes = sorted(db_rollups.items(), key=lambda item: -item[1])
+        if start_date is None and end_date is None:
+            pieces, raw = [(sizes[0][0], None, None)], []
+        else:
+            lo = to_epoch(start_date) if start_date is not None else 0
+            hi = to_epoch(end_date) + 1 if end_date is not None else 2 ** 62
+            pieces, raw = cover_range(lo, hi, sizes)
+        for name, first, end in pieces:
+            sql = "SELECT min(vmin), max(vmax), sum(vsum), sum(cnt), max(last_ts) FROM rollup_" + name + " WHERE device_id = ?"
+            if first is None:
+                parts.append(conn.execute(sql, (did,)).fetchone())
+            else:
+                parts.append(conn.execute(sql + " AND bucket >= ? AND bucket < ?", (did, first, end)).fetchone())
+        for lo, hi in raw:
+            sql, args = union_sql("SELECT ts, value FROM {table} WHERE device_id = ? AND ts >= ? AND ts < ?"
+                                  " AND value IS NOT NULL", partition_sources(conn, lo, hi - 1), (did, lo, hi))
+            parts.append(conn.execute("SELECT min(value), max(value), sum(value), count(value), max(ts) FROM (" + sql + ")",
+                                      args).fetchone())
+    parts = [part for part in parts if part[3]]
+    if not parts:
+        return None, None, None, 0, None
+    count = sum(part[3] for part in parts)
+    last_ts = max(part[4] for part in parts)
+    # the most recently inserted reading wins a tie; the inbox holds the newest rows
+    for table in reversed(partition_sources(conn, last_ts, last_ts)):
+        last = conn.execute("SELECT value FROM " + table + " WHERE device_id = ? AND ts = ? AND value IS NOT NULL"
+                            " ORDER BY rowid DESC LIMIT 1", (did, last_ts)).fetchone()
+        if last:
+            break
+    else:  # raw readings removed by retention, the rollup still has the value
+        name, size = sizes[0]
+        last = conn.execute("SELECT vlast FROM rollup_" + name + " WHERE device_id = ? AND bucket = ? AND last_ts = ?",
+                            (did, last_ts // size * size, last_ts)).fetchone()
+    return (min(part[0] for part in parts), max(part[1] for part in parts),
+            sum(part[2] for part in parts) / count, count, last[0] if last else None)
+
+
     # Fetch data from a database and table into a DataFrame with filtering
 
 
@@ -283,9 +1608,8 @@ def fetch_data(database, table_name, filter):
     :return: DataFrame of filtered data
     """
     TABLE_NAME = table_name
-    conn = create_connection(database)
-    with conn:
-        return fetch_table_data_into_df(TABLE_NAME, conn, filter)
+    conn = get_connection(database)
+    return fetch_table_data_into_df(TABLE_NAME, conn, filter, database)
 
 
 # Display graph of data for a specific meter between dates
@@ -293,7 +1617,8 @@ def graph_data(meter, start_date, end_date, database=db_name):
     """
     Display a graph of meter data between specific dates.
     """
-    df = pd.DataFrame(filter_by_date('data', start_date, end_date, meter), columns=['name', 'timestamp', 'value'])
+    df = pd.DataFrame(query_rollup(meter, start_date, end_date),
+                      columns=['name', 'timestamp', 'min', 'max', 'value', 'count', 'last'])
     plt.plot(pd.to_datetime(df['timestamp']), df['value'])
     plt.xlabel("Timestamp")
     plt.ylabel(meter)
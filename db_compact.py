@@ -0,0 +1,13 @@
+# Partition maintenance for the SafeSleep DB: move inbox rows to their monthly partitions,
+# compact old months into the yearly archive files and apply the retention policy
+# usage: python db_compact.py [database]
+import sys
+from init import *
+import data_acquisition as da
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else db_name
+    da.init_db(database)
+    moved, archived, deleted = da.maintain_partitions(database)
+    print(database + ': ' + str(moved) + ' inbox rows moved, ' + str(archived) + ' partitions archived, ' +
+          str(deleted) + ' deleted')
@@ -0,0 +1,13 @@
+# Import a historical CSV export (name,timestamp,value) into the SafeSleep DB
+# usage: python db_import.py [csv file] [--drop-indexes] [--restart]
+import sys
+from init import *
+import data_acquisition as da
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    da.init_db(db_name)
+    imported, skipped = da.import_csv(args[0] if args else csv_data_file,
+                                      drop_indexes='--drop-indexes' in sys.argv,
+                                      resume='--restart' not in sys.argv)
+    print(str(imported) + ' rows imported, ' + str(skipped) + ' skipped')
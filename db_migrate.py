@@ -0,0 +1,12 @@
+# Migrate a SafeSleep database to the current schema version, in place
+# usage: python db_migrate.py [database] [--vacuum]
+import sys
+from init import *
+import data_acquisition as da
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    database = args[0] if args else db_name
+    moved, skipped = da.migrate_db(database, vacuum='--vacuum' in sys.argv)
+    da.init_db(database)  # later schema versions: aggregates and monthly partitions
+    print(database + ': ' + str(moved) + ' rows migrated, ' + str(skipped) + ' skipped')
@@ -0,0 +1,187 @@
+# Device host: many emulated devices in one process over one MQTT connection
+# usage: python device_host.py [devices_file] [--count=N] [--seconds=S] [--name=client_id]
+# devices_file has one 'Name Units Place UpdateTime' line per device, as the emulator.py
+# arguments in start_emulators.bat (the default set); --count=N hosts N copies of each
+# ('DHT-1-0001' on '/Room_1-0001', ...). Updates are scheduled on a shared timer wheel instead
+# of a timer (and a process, a client and a TCP connection) per device.
+import sys
+import math
+import time
+import random
+from init import *
+from agent import MqttClient, TopicRouter
+from devices import Device
+from spool import Spool, spool_path
+from icecream import ic
+from datetime import datetime
+
+ic.configureOutput(prefix=lambda: f'{datetime.now()}  Device host|> ', includeContext=False)
+
+# the devices of start_emulators.bat
+default_devices = [('DHT-1', 'Celsius', '/Room_1', 7), ('ElecSensitivityMeter', 'kWh', '/Home', 13),
+                   ('Alarm', 'N', '/Bed-Alarm', 5), ('Motion', 'km', '/Motion', 8)]
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: slots of `tick` sec, an entry due in a later round waits in its slot.
+    schedule() is O(1) and advance() touches only the slots of the elapsed ticks, however
+    many timers are pending.
+    usage: wheel.schedule(when, item); for item in wheel.advance(time.monotonic()): ...
+    """
+
+    def __init__(self, tick=host_tick, slots=host_wheel_slots, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.pending = 0
+
+    def schedule(self, when, item):
+        """
+        Add a timer firing item at monotonic time `when` (at the latest one tick later).
+        """
+        due = max(math.ceil(when / self.tick), self.current + 1)
+        self.slots[due % len(self.slots)].append((due, item))
+        self.pending += 1
+
+    def advance(self, now):
+        """
+        :return: items due up to now, in due order
+        """
+        target = int(now / self.tick)
+        if target <= self.current:
+            return []
+        due = []
+        size = len(self.slots)
+        for t in range(self.current + 1, min(target, self.current + size) + 1):
+            slot = self.slots[t % size]
+            if slot:
+                keep = []
+                for entry in slot:
+                    (due if entry[0] <= target else keep).append(entry)
+                self.slots[t % size] = keep
+        self.current = target
+        self.pending -= len(due)
+        due.sort(key=lambda entry: entry[0])
+        return [item for _, item in due]
+
+
+class DeviceHost:
+    """
+    Serve many logical devices, each with its own topics, update interval and state,
+    over one MqttClient connection.
+    usage: host = DeviceHost([Device('DHT-1', 'Celsius', '/Room_1', 7), ...]); host.run()
+    """
+
+    def __init__(self, devices, mc=None, clientname=None):
+        self.devices = list(devices)
+        self.mc = mc if mc is not None else MqttClient()
+        if mc is None:
+            self.mc.set_broker(broker_ip)
+            self.mc.set_port(int(port))
+            # by default named after the hosted devices: a restart resumes the same spool, while
+            # hosts of other devices (the way to spread them over cores) get their own
+            clientname = clientname or f"DeviceHost-{self.devices[0].name}-{len(self.devices)}"
+            self.mc.set_clientname(clientname)
+            self.mc.set_username(username)
+            self.mc.set_password(password)
+            self.mc.set_spool(Spool(spool_path(clientname)))  # one spool per host process
+        self.mc.on_message = self.on_message  # before connect_to(), which hands it to paho
+        # commands for the listening devices, by their topic_sub
+        self.router = TopicRouter()
+        for device in self.devices:
+            if device.subscribes:
+                self.router.add(device.topic_sub, device)
+        self.wheel = TimerWheel()
+        self.published = 0
+
+    def on_message(self, client, userdata, msg):
+        message = msg.payload.decode('utf-8', 'ignore')
+        for device in self.router.match(msg.topic):
+            if device.on_command(message):
+                ic(device.name + ': ' + message)
+
+    def start(self):
+        """
+        Connect, subscribe and schedule the first update of every device at a random point of
+        its interval, so the devices do not all publish in the same tick.
+        """
+        self.mc.connect_to()
+        self.mc.start_listening()
+        for topic in self.router.filters():
+            self.mc.subscribe_to(topic)
+        now = time.monotonic()
+        for device in self.devices:
+            if device.publishes and device.update_rate > 0:
+                self.wheel.schedule(now + random.uniform(0, device.update_rate), (now, device))
+
+    def run_once(self, now):
+        """
+        Publish the updates due by now and schedule the next ones.
+        :return: number of messages published
+        """
+        sent = 0
+        for due, device in self.wheel.advance(now):
+            data = device.next_message()
+            if data is None:
+                continue  # listen-only device
+            self.mc.publish_to(device.topic_pub, data)
+            sent += 1
+            # next update one interval after this one; restart the cadence if we fell behind
+            due = max(due, now - device.update_rate) + device.update_rate
+            self.wheel.schedule(due, (due, device))
+        self.published += sent
+        return sent
+
+    def run(self, seconds=None, report_interval=60):
+        """
+        Run the devices until seconds elapse (None - until Ctrl-C).
+        """
+        self.start()
+        started = last_report = time.monotonic()
+        try:
+            while seconds is None or time.monotonic() - started < seconds:
+                time.sleep(self.wheel.tick)
+                now = time.monotonic()
+                self.run_once(now)
+                if now - last_report >= report_interval:
+                    ic(f"{len(self.devices)} devices, {self.published} messages published")
+                    last_report = now
+        except KeyboardInterrupt:
+            ic("interrupted by keyboard")
+        self.mc.stop_listening()
+        self.mc.disconnect_from()
+
+
+def load_devices(path=None, count=1):
+    """
+    :param path: file of 'Name Units Place UpdateTime' lines, None for default_devices
+    :param count: copies of each device, suffixed '-0001', '-0002', ... when more than one
+    :return: list of Device
+    """
+    specs = default_devices
+    if path:
+        with open(path) as f:
+            specs = [line.split() for line in f if line.strip() and not line.lstrip().startswith(('#', '//'))]
+    if count == 1:
+        return [Device(*spec[:4]) for spec in specs]
+    return [Device(f'{name}-{i:04d}', units, f'{place}-{i:04d}', rate)
+            for name, units, place, rate in (spec[:4] for spec in specs) for i in range(1, count + 1)]
+
+
+def option(name, default=None):
+    """
+    :return: value of a --name=value argument
+    """
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return arg.split('=', 1)[1]
+    return default
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    devices = load_devices(args[0] if args else None, int(option('count', 1)))
+    ic(f"Hosting {len(devices)} devices over one connection to {broker_ip}")
+    seconds = option('seconds')
+    DeviceHost(devices, clientname=option('name')).run(float(seconds) if seconds else None)
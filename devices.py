@@ -0,0 +1,94 @@
+# Emulated IoT devices without Qt
+# Topics, update interval, state and reading generators of one emulated device, shared by
+# emulator.py (one window per device) and device_host.py (many devices over one connection).
+import time
+import random
+from init import *
+import payload
+from icecream import ic
+
+# The device kind is picked by a substring of its name, e.g. 'DHT-1' or 'ElecSensitivityMeter'
+device_kinds = ('DHT', 'Meter', 'Alarm', 'Motion')
+
+
+def device_kind(name):
+    """
+    :return: the first of device_kinds contained in the device name, None if none is
+    """
+    for kind in device_kinds:
+        if kind in name:
+            return kind
+    return None
+
+
+class Device:
+    """
+    One emulated device; its readings carry their sample time, so a reading published late
+    from a spool is stored under the time it was taken.
+    usage: dev = Device('DHT-1', 'Celsius', '/Room_1', 7); publish(dev.topic_pub, dev.next_message())
+    """
+
+    base_temperature = {'DHT': 22, 'Motion': 80}
+
+    def __init__(self, name, units, place, update_rate):
+        """
+        :param place: topic level of the device, e.g. '/Room_1' (topics comm_topic + place + '/pub' and '/sub')
+        :param update_rate: sec between updates
+        """
+        self.name = name
+        self.units = units
+        self.topic_sub = comm_topic + place + '/sub'
+        self.topic_pub = comm_topic + place + '/pub'
+        self.update_rate = float(update_rate)
+        self.kind = device_kind(name)
+        self.tmp_upd = self.base_temperature.get(self.kind, 22)  # temperature set by the manager's commands
+        self.subscribes = self.kind in ('Alarm', 'Motion')  # devices that listen on topic_sub
+        self.publishes = self.kind in ('DHT', 'Meter', 'Motion')  # devices with readings on topic_pub
+        self.values = ()  # last generated reading
+        self.state = ''  # '' or 'Set' once a command was received
+
+    def create_data(self):
+        """DHT reading."""
+        self.values = (self.tmp_upd + random.randrange(1, 10), 74 + random.randrange(1, 25))
+        return payload.encode('dht', self.name, self.values, ts=time.time())
+
+    def create_data_EW(self):
+        """Electricity and sensitivity reading."""
+        hour_delta_w = 0.42 / 24
+        hour_delta_el = (670 / 17) / 24
+        elec = round(hour_delta_el + random.randrange(-100, 100) / 300, 2)
+        sensitivity = round(hour_delta_w + random.randrange(-10, 10) / 1000, 3)
+        self.values = (elec, sensitivity)
+        return payload.encode('meter', self.name, self.values, ts=time.time())
+
+    def create_data_Air(self):
+        """The alarm only listens for commands."""
+        return None
+
+    def create_data_Bo(self):
+        """Motion sensor reading."""
+        self.values = (self.tmp_upd + random.randrange(1, 20) / 2,)
+        return payload.encode('motion', self.name, self.values, ts=time.time())
+
+    generators = {'DHT': create_data, 'Meter': create_data_EW, 'Alarm': create_data_Air, 'Motion': create_data_Bo}
+
+    def next_message(self):
+        """
+        :return: payload of the next update, None for devices that publish nothing
+        """
+        generator = self.generators.get(self.kind)
+        return None if generator is None else generator(self)
+
+    def on_command(self, message):
+        """
+        Apply a command received on topic_sub ('Set temperature to: 21').
+        :return: True if the message was a command
+        """
+        if 'Set' not in message:
+            return False
+        self.state = 'Set'
+        try:
+            self.tmp_upd = float(message.split('Set temperature to: ')[1])
+        except (IndexError, ValueError):
+            ic("Failed to parse temperature.")
+        return True
@@ -1,12 +1,16 @@
 # Emulator for Home IoT Devices (DHT, Electric meter, Sensitivity meter, etc.)
+# usage: python emulator.py Name Units Place UpdateTime       (one device, one window)
+#        python emulator.py --engine [devices_file] [--count=N] (viewer of a headless emulator_engine.py run)
 import sys
-import random
+import socket
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from init import *
 from agent import Mqtt_client
+from devices import Device
+from spool import Spool, spool_path
 from icecream import ic
 from datetime import datetime
 import logging
@@ -27,9 +31,9 @@ def time_format():
 
 ic.configureOutput(prefix=time_format, includeContext=False)
 
-# Generate unique client name
-global clientname, tmp_upd
-clientname = f"IOT_clYT-Id-{random.randrange(1, 10000000)}"
+# Client name prefix; the device name completes it, so a restarted emulator resumes its broker session
+global clientname
+clientname = f"IOT_clYT-{socket.gethostname()}-"
 
 
 class MC(Mqtt_client):
@@ -75,7 +79,7 @@ class ConnectionDock(QDockWidget):
         self.ePort.setText(broker_port)
 
         self.eClientID = QLineEdit()
-        self.eClientID.setText(clientname)
+        self.eClientID.setText(clientname + self.name)
 
         self.eUserName = QLineEdit()
         self.eUserName.setText(username)
@@ -90,7 +94,7 @@ class ConnectionDock(QDockWidget):
 
         self.eSSL = QCheckBox()
         self.eCleanSession = QCheckBox()
-        self.eCleanSession.setChecked(True)
+        self.eCleanSession.setChecked(mqtt_clean_session)
 
         self.eConnectbtn = QPushButton("Enable/Connect", self)
         self.eConnectbtn.setToolTip("Click to connect")
@@ -157,6 +161,7 @@ class ConnectionDock(QDockWidget):
         self.mc.set_broker(self.eHostInput.text())
         self.mc.set_port(int(self.ePort.text()))
         self.mc.set_clientName(self.eClientID.text())
+        self.mc.set_clean_session(self.eCleanSession.isChecked())
         self.mc.set_username(self.eUserName.text())
         self.mc.set_password(self.ePassword.text())
         self.mc.connect_to()
@@ -168,16 +173,9 @@ class ConnectionDock(QDockWidget):
 
     def update_btn_state(self, messg):
         """Update button state based on the received message."""
-        global tmp_upd
-        if 'Set' in messg:
-            tmp = '12'
+        if mainwin.device.on_command(messg):
             self.ePushtbtn.setStyleSheet("background-color: green")
-            try:
-                tmp = messg.split('Set temperature to: ')[1]
-                self.Temperature.setText(tmp)
-            except:
-                ic("Failed to parse temperature.")
-            tmp_upd = tmp
+            self.Temperature.setText(str(mainwin.device.tmp_upd))
 
 
 class MainWindow(QMainWindow):
@@ -191,13 +189,14 @@ class MainWindow(QMainWindow):
 
     def init_args(self, args):
         """Initialize arguments and set instance variables."""
-        global tmp_upd
-        self.name = args[1]
-        self.units = args[2]
-        self.topic_sub = comm_topic + args[3] + '/sub'
-        self.topic_pub = comm_topic + args[3] + '/pub'
+        self.device = Device(args[1], args[2], args[3], args[4])  # topics, state and readings
+        self.name = self.device.name
+        self.units = self.device.units
+        self.topic_sub = self.device.topic_sub
+        self.topic_pub = self.device.topic_pub
         self.update_rate = args[4]
         self.mc = MC()
+        self.mc.set_spool(Spool(spool_path('emulator-' + self.name)))  # the device's spool survives restarts
 
         # Set initial values and timers based on device type
         self.setup_timers()
@@ -205,7 +204,6 @@ class MainWindow(QMainWindow):
     def setup_timers(self):
         """Setup timers based on device type."""
         if 'DHT' in self.name:
-            tmp_upd = 22
             self.timer = QtCore.QTimer(self)
             self.timer.timeout.connect(self.create_data)
             self.timer.start(int(self.update_rate) * 1000)
@@ -218,7 +216,6 @@ class MainWindow(QMainWindow):
             self.timer.timeout.connect(self.create_data_Air)
             self.timer.start(int(self.update_rate) * 1000)
         elif 'Motion' in self.name:
-            tmp_upd = 80
             self.timer = QtCore.QTimer(self)
             self.timer.timeout.connect(self.create_data_Bo)
             self.timer.start(int(self.update_rate) * 1000)
@@ -236,11 +233,9 @@ class MainWindow(QMainWindow):
 
     def create_data(self):
         """Create and publish DHT data."""
-        global tmp_upd
         ic('Next update')
-        temp = tmp_upd + random.randrange(1, 10)
-        hum = 74 + random.randrange(1, 25)
-        current_data = f'From: {self.name} Temperature: {temp} Humidity: {hum}'
+        current_data = self.device.create_data()
+        temp, hum = self.device.values
         self.connectionDock.Temperature.setText(str(temp))
         self.connectionDock.Humidity.setText(str(hum))
         self.ensure_connected()
@@ -249,11 +244,8 @@ class MainWindow(QMainWindow):
     def create_data_EW(self):
         """Create and publish electricity and sensitivity data."""
         ic('Electricity-Sensitivity data update')
-        hour_delta_w = 0.42 / 24
-        hour_delta_el = (670 / 17) / 24
-        elec = format(hour_delta_el + random.randrange(-100, 100) / 300, '.2f')
-        Sensitivity = format(hour_delta_w + random.randrange(-10, 10) / 1000, '.3f')
-        current_data = f'From: {self.name} Electricity: {elec} Sensitivity: {Sensitivity}'
+        current_data = self.device.create_data_EW()
+        elec, Sensitivity = self.device.values
         self.connectionDock.Temperature.setText(str(elec))
         self.connectionDock.Humidity.setText(str(Sensitivity))
         self.ensure_connected()
@@ -266,11 +258,10 @@ class MainWindow(QMainWindow):
 
     def create_data_Bo(self):
         """Create and publish motion data."""
-        global tmp_upd
         ic('Motion data update')
         self.ensure_connected(subscribe=True)
-        temp = tmp_upd + random.randrange(1, 20) / 2
-        current_data = f'Temperature: {temp}'
+        current_data = self.device.create_data_Bo()
+        temp, = self.device.values
         self.connectionDock.Temperature.setText(str(temp))
         self.mc.publish_to(self.topic_pub, current_data)
 
@@ -282,13 +273,52 @@ class MainWindow(QMainWindow):
             self.mc.subscribe_to(self.topic_sub)
 
 
+class EngineView(QMainWindow):
+    """Table of the devices of a running EmulatorEngine, refreshed every second."""
+
+    def __init__(self, engine, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+        self.devices = engine.devices[:engine_view_rows]
+        self.table = QTableWidget(len(self.devices), 4)
+        self.table.setHorizontalHeaderLabels(['Device', 'Topic', 'Reading', 'State'])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        for row, device in enumerate(self.devices):
+            self.table.setItem(row, 0, QTableWidgetItem(device.name))
+            self.table.setItem(row, 1, QTableWidgetItem(device.topic_pub))
+        self.setCentralWidget(self.table)
+        self.setGeometry(30, 100, 700, 500)
+        self.setWindowTitle(f"Emulator engine: {len(engine.devices)} devices")
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+
+    def refresh(self):
+        # the engine thread only replaces values/state, reading them here needs no lock
+        for row, device in enumerate(self.devices):
+            self.table.setItem(row, 2, QTableWidgetItem(' '.join(str(v) for v in device.values)))
+            self.table.setItem(row, 3, QTableWidgetItem(device.state))
+        stats = self.engine.stats()
+        self.statusBar().showMessage(f"{stats['connections']} connection(s), {stats['published']} published, "
+                                     f"{stats['skipped']} skipped, lag p99 {stats['lag_p99'] * 1e3:.0f} ms")
+
+
 if __name__ == '__main__':
     try:
         app = QApplication(sys.argv)
         argv = sys.argv
-        if len(argv) == 1:
-            argv.extend(['Alarm', 'Celsius', 'air-1', '7'])
-        mainwin = MainWindow(argv)
+        if '--engine' in argv:
+            from emulator_engine import EmulatorEngine
+            from device_host import load_devices, option
+            ic.configureOutput(prefix=time_format, includeContext=False)  # device_host sets its own
+            args = [arg for arg in argv[1:] if not arg.startswith('--')]
+            engine = EmulatorEngine(load_devices(args[0] if args else None, int(option('count', 1))))
+            engine.start_in_thread()
+            mainwin = EngineView(engine)
+        else:
+            if len(argv) == 1:
+                argv.extend(['Alarm', 'Celsius', 'air-1', '7'])
+            mainwin = MainWindow(argv)
         mainwin.show()
         app.exec_()
     except:
@@ -0,0 +1,189 @@
+# Headless emulator engine: thousands of emulated devices on one asyncio loop, no Qt
+# usage: python emulator_engine.py [devices_file] [--count=N] [--interval=S] [--scale=F] [--seconds=S] [--processes=P]
+# Devices come from device_host.load_devices (start_emulators.bat format, --count copies of each)
+# and publish the devices.py readings; --interval sets every update interval, --scale multiplies
+# them (0.1 - ten times faster). Devices share AsyncMqttClient connections
+# (engine_devices_per_connection each) and one timer wheel; --processes=P splits them over P
+# processes with a loop each. emulator.py --engine shows a running engine in a Qt window.
+import sys
+import time
+import random
+import asyncio
+import threading
+import multiprocessing as mp
+from init import *
+from agent import AsyncMqttClient, TopicRouter
+from device_host import TimerWheel, load_devices, option
+import metrics
+from icecream import ic
+from datetime import datetime
+
+
+class EmulatorEngine:
+    """
+    Drive many devices.Device objects from one event loop.
+    usage: engine = EmulatorEngine(load_devices(count=2500)); asyncio.run(engine.run(60))
+           or engine.start_in_thread() next to a viewer reading engine.devices
+    """
+
+    def __init__(self, devices, per_connection=engine_devices_per_connection, rate_scale=engine_rate_scale,
+                 interval=None, name='Engine'):
+        """
+        :param interval: update interval (sec) of every device, None - each device's update_rate * rate_scale
+        """
+        self.devices = list(devices)
+        self.per_connection = max(1, per_connection)
+        self.rate_scale = rate_scale
+        self.interval = interval
+        self.name = name
+        self.published = self.skipped = self.failed = 0
+        self.lag = metrics.Histogram('engine_lag_seconds', 'Update publish time behind schedule')
+        self.listeners = []  # called as listener(device) after each published update
+        self.clients = []
+        self.running = False
+
+    def period(self, device):
+        return self.interval if self.interval else device.update_rate * self.rate_scale
+
+    async def run(self, seconds=None, report_interval=60):
+        """
+        Connect, run the devices until seconds elapse (None - until cancelled) and disconnect.
+        """
+        self.running = True
+        groups = [self.devices[i:i + self.per_connection] for i in range(0, len(self.devices), self.per_connection)]
+        tag = f"{self.name}-{random.randrange(1, 10000000)}"
+        self.clients = [AsyncMqttClient(f"{tag}-{i}", clean_session=True) for i in range(len(groups))]
+        connected = await asyncio.gather(*(client.connect(mqtt_connect_timeout) for client in self.clients))
+        if not all(connected):  # they keep reconnecting; their devices skip updates meanwhile
+            ic(f"{connected.count(False)} of {len(self.clients)} connection(s) to {broker_ip} not up yet")
+        tasks, subscribes = [], []
+        for client, group in zip(self.clients, groups):
+            router = TopicRouter()
+            for device in group:
+                if device.subscribes:
+                    router.add(device.topic_sub, device)
+                    subscribes.append(client.subscribe(device.topic_sub))
+            if router.routes:
+                tasks.append(asyncio.ensure_future(self.commands(client, router)))
+        # all SUBSCRIBEs in flight at once: one round trip, not one per device
+        await asyncio.gather(*subscribes, return_exceptions=True)
+        ic(f"{len(self.devices)} devices on {len(self.clients)} connection(s) to {broker_ip}")
+        try:
+            await self.schedule(groups, seconds, report_interval)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*(client.disconnect() for client in self.clients))
+            self.running = False
+
+    async def commands(self, client, router):
+        """
+        Hand the messages on the devices' sub topics to Device.on_command.
+        """
+        async for msg in client.messages():
+            message = msg.payload.decode('utf-8', 'ignore')
+            for device in router.match(msg.topic):
+                device.on_command(message)
+
+    async def schedule(self, groups, seconds, report_interval):
+        """
+        Publish every device's updates from one timer wheel; each device starts at a random
+        point of its interval so the updates spread evenly over time.
+        """
+        wheel = TimerWheel()
+        now = started = last_report = time.monotonic()
+        for client, group in zip(self.clients, groups):
+            for device in group:
+                if device.publishes and self.period(device) > 0:
+                    due = now + random.uniform(0, self.period(device))
+                    wheel.schedule(due, (due, device, client))
+        last_count = 0
+        while seconds is None or now - started < seconds:
+            await asyncio.sleep(wheel.tick)
+            now = time.monotonic()
+            sends = []
+            for due, device, client in wheel.advance(now):
+                self.lag.observe(max(0.0, now - due))
+                if client.connected.is_set():
+                    sends.append(self.send(client, device))
+                else:
+                    self.skipped += 1  # a device without connection has nobody to report to
+                period = self.period(device)
+                due = max(due, now - period) + period
+                wheel.schedule(due, (due, device, client))
+            if sends:
+                await asyncio.gather(*sends)
+            if now - last_report >= report_interval:
+                ic(f"{self.published} published ({(self.published - last_count) / (now - last_report):.0f}/s), "
+                   f"{self.skipped} skipped, {self.failed} failed, lag p99 {self.lag.quantile(0.99) * 1e3:.0f}ms")
+                last_report, last_count = now, self.published
+
+    async def send(self, client, device):
+        data = device.next_message()
+        try:
+            await client.publish(device.topic_pub, data)
+        except ConnectionError:
+            self.failed += 1
+            return
+        self.published += 1
+        for listener in self.listeners:
+            listener(device)
+
+    def start_in_thread(self, seconds=None):
+        """
+        Run the engine on its own event loop in a daemon thread (e.g. under the Qt viewer).
+        :return: the thread
+        """
+        thread = threading.Thread(target=lambda: asyncio.run(self.run(seconds)), name='emulator-engine', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        return {'devices': len(self.devices), 'connections': len(self.clients), 'published': self.published,
+                'skipped': self.skipped, 'failed': self.failed, 'lag_p99': self.lag.quantile(0.99)}
+
+
+def run_worker(devices, seconds, interval, rate_scale, name, results):
+    ic.configureOutput(prefix=lambda: f'{datetime.now()}  {name}|> ', includeContext=False)
+    engine = EmulatorEngine(devices, rate_scale=rate_scale, interval=interval, name=name)
+    try:
+        asyncio.run(engine.run(seconds))
+    except KeyboardInterrupt:
+        pass
+    results.put(engine.stats())
+
+
+def run_processes(devices, processes, seconds=None, interval=None, rate_scale=engine_rate_scale):
+    """
+    Split the devices over several processes, one engine each.
+    :return: list of the engines' stats
+    """
+    results = mp.Queue()
+    workers = [mp.Process(target=run_worker, args=(devices[k::processes], seconds, interval, rate_scale,
+                                                   f'Engine-{k}', results)) for k in range(processes)]
+    for worker in workers:
+        worker.start()
+    stats = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return stats
+
+
+if __name__ == '__main__':
+    ic.configureOutput(prefix=lambda: f'{datetime.now()}  Engine|> ', includeContext=False)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    devices = load_devices(args[0] if args else None, int(option('count', 1)))
+    seconds = float(option('seconds')) if option('seconds') else None
+    interval = float(option('interval')) if option('interval') else None
+    scale = float(option('scale', engine_rate_scale))
+    processes = int(option('processes', 1))
+    if processes > 1:
+        for stats in run_processes(devices, processes, seconds, interval, scale):
+            print(stats)
+    else:
+        engine = EmulatorEngine(devices, rate_scale=scale, interval=interval)
+        try:
+            asyncio.run(engine.run(seconds, report_interval=10))
+        except KeyboardInterrupt:
+            pass
+        print(engine.stats())
@@ -9,11 +9,12 @@ from PyQt5.QtCore import *
 from matplotlib.pyplot import get
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 from init import *
-from agent import Mqtt_client 
+from agent import Mqtt_client, TopicRouter
 import time
 from icecream import ic
 from datetime import datetime 
 import data_acquisition as da
+import payload
 # pip install pyqtgraph
 #from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
@@ -42,8 +43,6 @@ logger.addHandler(file_handler)
 # logger.critical('Fatal error. Cannot continue')
 
 
-global WatMet
-WatMet=True
 def time_format():
     return f'{datetime.now()}  GUI|> '
 ic.configureOutput(prefix=time_format)
@@ -63,26 +62,32 @@ def check(fnk):
 class MC(Mqtt_client):
     def __init__(self):
         super().__init__()
+        # topic filter -> handler(msg); the GUI subscribes to these filters
+        self.router = TopicRouter()
+        self.router.add(comm_topic+'alarm', self.on_alarm)
+        self.router.add(comm_topic+'/Room_1/#', self.on_room)
+        self.router.add(comm_topic+'/Common/#', self.on_room)
+        self.router.add(comm_topic+'/Home/#', self.on_meter)
+        self.router.add(comm_topic+'/Motion/#', self.on_motion)
     def on_message(self, client, userdata, msg):
-            global WatMet
-            topic=msg.topic            
+            if not self.router.dispatch(msg.topic, msg):
+                ic("message from:"+msg.topic+" not routed")
+    def decode(self, msg):
+            name, fields = payload.decode(msg.payload) # one pass, any payload format
+            ic("message from:"+msg.topic, name, fields)
+            return fields
+    def on_alarm(self, msg):
             m_decode=str(msg.payload.decode("utf-8","ignore"))
-            ic("message from:"+topic, m_decode)
-            if 'Room_1' in topic:
-                mainwin.airconditionDock.update_temp_Room(check(m_decode.split('Temperature: ')[1].split(' Humidity: ')[0]))
-            if 'Common' in topic:            
-                mainwin.airconditionDock.update_temp_Room(check(m_decode.split('Temperature: ')[1].split(' Humidity: ')[0]))
-            if 'Home' in topic:               
-                if WatMet:
-                    mainwin.graphsDock.update_electricity_meter(check(m_decode.split('Electricity: ')[1].split(' Sensitivity: ')[0]))
-                    WatMet = False
-                else:
-                    mainwin.graphsDock.update_Sensitivity_meter(check(m_decode.split(' Sensitivity: ')[1]))
-                    WatMet = True
-            if 'alarm' in topic:            
-                mainwin.statusDock.update_mess_win(da.timestamp()+': ' + m_decode)
-            if 'motion' in topic:
-                mainwin.statusDock.motionTemp.setText(check(m_decode.split('Temperature: ')[1]))
+            ic("message from:"+msg.topic, m_decode)
+            mainwin.statusDock.update_mess_win(da.timestamp()+': ' + m_decode)
+    def on_room(self, msg):
+            mainwin.airconditionDock.update_temp_Room(payload.text(self.decode(msg), 'Temperature'))
+    def on_meter(self, msg):
+            fields = self.decode(msg) # every meter message carries both readings
+            mainwin.graphsDock.update_electricity_meter(payload.text(fields, 'Electricity'))
+            mainwin.graphsDock.update_Sensitivity_meter(payload.text(fields, 'Sensitivity'))
+    def on_motion(self, msg):
+            mainwin.statusDock.motionTemp.setText(payload.text(self.decode(msg), 'Temperature'))
 
    
 class ConnectionDock(QDockWidget):
@@ -90,7 +95,7 @@ class ConnectionDock(QDockWidget):
     def __init__(self,mc):
         QDockWidget.__init__(self)        
         self.mc = mc
-        self.topic = comm_topic+'#'        
+        self.topics = self.mc.router.filters() # what MC.on_message routes
         self.mc.set_on_connected_to_form(self.on_connected)        
         self.eHostInput=QLineEdit()
         self.eHostInput.setInputMask('999.999.999.999')
@@ -124,11 +129,13 @@ class ConnectionDock(QDockWidget):
         self.mc.set_broker(self.eHostInput.text())
         self.mc.set_port(int(self.ePort.text()))
         self.mc.set_clientName(self.eClientID.text())           
+        self.mc.set_clean_session(True) # random client id per run: a persistent session would never be resumed
         self.mc.connect_to()        
         self.mc.start_listening()
         time.sleep(1)
         if not self.mc.subscribed:
-            self.mc.subscribe_to(self.topic)
+            for topic in self.topics:
+                self.mc.subscribe_to(topic)
             
 class StatusDock(QDockWidget):
     """Status """
@@ -184,6 +191,13 @@ class GraphsDock(QDockWidget):
         self.eSensitivityButton.clicked.connect(self.on_button_Sensitivity_click)
         self.eSensitivityText= QLineEdit()
         self.eSensitivityText.setText(" ")
+        # show the newest stored readings until the first live message arrives
+        latest = da.get_latest('ElectricityMeter')
+        if latest is not None:
+            self.eElectricityText.setText(str(latest[1]))
+        latest = da.get_latest('SensitivityMeter')
+        if latest is not None:
+            self.eSensitivityText.setText(str(latest[1]))
         self.eStartDate= QLineEdit()
         self.eEndDate= QLineEdit()
         self.eStartDate.setText("2021-05-10")
@@ -223,12 +237,12 @@ class GraphsDock(QDockWidget):
         self.eElectricityButton.setStyleSheet("background-color: yellow")
 
     def update_plot(self,date_st,date_end, meter):
-        rez= da.filter_by_date('data',date_st,date_end, meter)
+        rez= da.query_rollup(meter, date_st, date_end) # per-bucket averages
         temperature = []  
         timenow = []       
         for row in rez:
             timenow.append(row[1])
-            temperature.append(float("{:.2f}".format(float(row[2]))))
+            temperature.append(round(row[4], 2))
         print(timenow)
         print(temperature)
         mainwin.plotsDock.plot(timenow, temperature) 
@@ -394,12 +408,12 @@ class PlotDock(QDockWidget):
         self.setWindowTitle("Plots")
         self.graphWidget = pg.PlotWidget()
         self.setWidget(self.graphWidget)
-        rez= da.filter_by_date('data','2021-05-16','2021-05-18', 'ElecMeter')        
+        rez= da.query_rollup('ElecMeter', '2021-05-16', '2021-05-18') # per-bucket averages
         datal = []  
         timel = []        
         for row in rez:
             timel.append(row[1])
-            datal.append(float("{:.2f}".format(float(row[2]))))
+            datal.append(round(row[4], 2))
         self.graphWidget.setBackground('b')
         # Add Title
         self.graphWidget.setTitle("Consuption Timeline", color="w", size="15pt")
@@ -0,0 +1,139 @@
+# Ingest queue between the MQTT network thread and the DB writer
+# The paho callback only enqueues; writer thread(s) parse and persist the messages,
+# so a slow commit never stalls keepalives or the receipt of other topics.
+import queue
+import threading
+from init import *
+import data_acquisition as da
+from icecream import ic
+
+
+class IngestQueue:
+    """
+    Bounded queue of incoming messages served by a pool of writer threads.
+    When the queue is full the policy decides:
+      'block'       - the producer waits up to put_timeout sec (backpressure), then the message is dropped
+      'drop_newest' - the incoming message is dropped
+      'drop_oldest' - the oldest waiting message is dropped to make room
+    usage: iq = IngestQueue(handler); iq.start(); iq.put(topic, payload) ... iq.stop()
+    """
+
+    policies = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, handler, maxsize=ingest_queue_size, policy=ingest_policy, workers=ingest_workers,
+                 put_timeout=ingest_put_timeout):
+        """
+        :param handler: called as handler(*item) in a writer thread for every queued item
+        :param workers: writer threads; 1 keeps the items in arrival order
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown ingest policy: ' + str(policy))
+        self.handler = handler
+        self.policy = policy
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize)
+        self.enqueued = self.processed = self.dropped = self.failed = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def put(self, *item):
+        """
+        Queue one item (called from the network thread).
+        :return: True if queued, False if dropped by the policy
+        """
+        try:
+            if self.policy == 'block':
+                self.queue.put(item, timeout=self.put_timeout)
+            elif self.policy == 'drop_newest':
+                self.queue.put_nowait(item)
+            else:
+                while True:
+                    try:
+                        self.queue.put_nowait(item)
+                        break
+                    except queue.Full:
+                        try:
+                            self.queue.get_nowait()
+                            self.queue.task_done()
+                            self._count('dropped')
+                        except queue.Empty:
+                            pass
+        except queue.Full:
+            self._count('dropped')
+            return False
+        depth = self.queue.qsize()
+        with self._lock:
+            self.enqueued += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is None:
+                        return
+                    self.handler(*item)
+                    self._count('processed')
+                except Exception as e:
+                    self._count('failed')
+                    ic(e)
+                finally:
+                    self.queue.task_done()
+        finally:
+            da.pool.release()  # the writer's pooled DB connection
+
+    def start(self):
+        """
+        Start the writer threads.
+        """
+        if self._threads:
+            return
+        self._threads = [threading.Thread(target=self._run, name='ingest-' + str(i), daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Process what is already queued, then stop the writer threads (shutdown hook).
+        """
+        for _ in self._threads:
+            self.queue.put(None)  # after the queued items, so they are written first
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self):
+        """
+        :return: number of items waiting
+        """
+        return self.queue.qsize()
+
+    def stats(self):
+        """
+        :return: dict of the queue counters and current/max depth
+        """
+        with self._lock:
+            return {'depth': self.queue.qsize(), 'max_depth': self.max_depth, 'capacity': self.queue.maxsize,
+                    'enqueued': self.enqueued, 'processed': self.processed, 'dropped': self.dropped,
+                    'failed': self.failed}
+
+    def report(self):
+        """
+        Log the queue depth and counters; the max depth restarts for the next period.
+        :return: the reported stats
+        """
+        stats = self.stats()
+        ic('ingest queue', stats)
+        with self._lock:
+            self.max_depth = self.queue.qsize()
+        return stats
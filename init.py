@@ -1,12 +1,17 @@
 # configuration module
 
+import os
 import socket
 
-nb=1 # 0- HIT-"139.162.222.115", 1 - open HiveMQ - broker.hivemq.com
-brokers=[str(socket.gethostbyname('vmm1.saaintertrade.com')), str(socket.gethostbyname('broker.hivemq.com')),"18 .194.176.210"]
-ports=['80','1883','1883']
-usernames = ['','',''] # should be modified for HIT
-passwords = ['','',''] # should be modified for HIT
+local_broker_host = '127.0.0.1' # mini_broker.py listens here (nb = 3 or SAFESLEEP_BROKER=3 connects everything to it)
+local_broker_port = 1883
+nb=int(os.environ.get('SAFESLEEP_BROKER', 1)) # 0- HIT-"139.162.222.115", 1 - open HiveMQ - broker.hivemq.com, 3 - local mini_broker.py (offline, no DNS)
+broker_hosts=['vmm1.saaintertrade.com', 'broker.hivemq.com', "18 .194.176.210", local_broker_host]
+ports=['80','1883','1883',str(local_broker_port)]
+usernames = ['','','',''] # should be modified for HIT
+passwords = ['','','',''] # should be modified for HIT
+# only the selected broker is resolved (host names need DNS, the local broker does not)
+brokers=[host if i != nb or host[:1].isdigit() else str(socket.gethostbyname(host)) for i, host in enumerate(broker_hosts)]
 broker_ip=brokers[nb]
 port=ports[nb]
 username = usernames[nb]
@@ -51,10 +56,77 @@ manag_time = 10 # sec
 # DB init data 
 db_name = 'data\\SafeSleep_05_2.db' # SQLite
 db_init =  False   #False # True if we need reinit SafeSleep Manager setup
+db_schema_version = 6 # 1 - data(name, timestamp, value) as TEXT; 2 - typed samples table; 3 - rollup tables; 4 - latest table; 5 - device change log; 6 - monthly partitions (see data_acquisition.init_db)
+db_stmt_cache = 128 # prepared statements kept per pooled connection
+db_journal_mode = 'WAL' # WAL - GUI/assistant readers never block the manager's writes; DELETE - rollback journal
+db_busy_timeout = 5000 # ms a connection waits on a lock before 'database is locked'
+db_wal_autocheckpoint = 1000 # WAL pages between automatic checkpoints; 0 - the manager checkpoints each cycle
+db_synchronous = 'NORMAL' # PRAGMA synchronous of pooled connections: OFF, NORMAL or FULL (durability vs. speed)
+db_write_buffered = False # True - add_IOT_data buffers rows and group-commits them
+db_batch_size = 500 # rows per group commit
+db_batch_age = 2.0 # sec, max time a buffered row waits before it is flushed
+db_rollups = {'minute': 60, 'hour': 3600, 'day': 86400} # rollup tables (rollup_<name>) and their bucket size, sec
+db_chunk_size = 10000 # rows per fetch/block of the streaming range readers
+csv_data_file = 'data/SafeSleepData.csv' # historical export with name,timestamp,value columns
+db_import_chunk = 100000 # CSV rows per import transaction
+db_change_batch = 500 # device changes read from the change log per manager cycle
+rollup_max_points = 1000 # plots/queries use the finest rollup with at most this many buckets in the range
+db_partition_hot_months = 3 # monthly partitions kept in the main DB besides the current month; older ones go to archives
+db_archive_dir = 'archive' # compacted archives, one DB file per year (samples_YYYY.db), still queried via ATTACH; relative to the DB file's directory
+db_retention_months = 0 # delete raw readings older than this many months, 0 - keep forever (rollups are kept)
+db_maintenance_interval = 3600 # sec between partition maintenance runs of the manager
+ingest_queue_size = 10000 # MQTT messages waiting between the network thread and the DB writer
+ingest_policy = 'block' # full queue: 'block' (wait ingest_put_timeout, then drop), 'drop_newest' or 'drop_oldest'
+ingest_put_timeout = 0.5 # sec the network thread may wait on a full queue with the 'block' policy
+ingest_workers = 1 # DB writer threads; 1 keeps the readings in arrival order
+ingest_report_interval = 60 # sec between queue depth reports of the manager
+threshold_poll_interval = 300 # sec between the manager's fallback alarm rule checks (readings are checked on ingest)
+payload_format = 'struct' # telemetry published by the emulators: 'struct' (compact binary), 'json' or 'text' (legacy); readers decode all three
+manager_shards = 1 # manager processes sharing the devices by topic hash (python coordinator.py N --spawn)
+shard_heartbeat_interval = 10 # sec between the retained heartbeats of the manager shards
+metrics_port = 9108 # manager metrics in the Prometheus text format on http://metrics_host:metrics_port/metrics, 0 - off
+metrics_host = '127.0.0.1' # local only
+metrics_prefix = 'safesleep_' # prefix of the metric names
+metrics_log_interval = 60 # sec between the manager's metrics summary log lines
+spool_dir = 'data/spool' # outbound spools (spool.py): publishes made while disconnected, sent in order on reconnect
+spool_max_bytes = 10 * 1024 * 1024 # per spool file; publishes beyond it are dropped
+spool_batch = 100 # spooled messages sent per drain batch
+spool_rate = 200 # messages/sec while draining a spool, 0 - unlimited
+spool_fsync = False # True - fsync every spooled publish (survives power loss, slower)
+mqtt_reconnect_min_delay = 1 # sec, reconnect backoff of agent.MqttClient: doubles per failed attempt, full jitter
+mqtt_reconnect_max_delay = 60 # sec, backoff cap
+mqtt_connect_timeout = 10 # sec, TCP connect of agent.AsyncMqttClient and its wait for the first CONNACK
+mqtt_clean_session = False # False - the broker keeps subscriptions and queued QoS 1 messages across reconnects (clients with a stable id; random ids always connect clean)
+router_cache_size = 10000 # topics whose matching handlers agent.TopicRouter keeps resolved
+host_tick = 0.1 # sec, timer wheel resolution of device_host.py
+host_wheel_slots = 512 # timer wheel slots (one round = host_tick * host_wheel_slots sec)
+local_broker_max_buffer = 1 << 20 # bytes unsent to a slow subscriber before its QoS 0 messages are dropped
+engine_devices_per_connection = 500 # emulated devices sharing one MQTT connection in emulator_engine.py
+engine_rate_scale = 1.0 # multiplies every emulated device's update interval (0.1 - ten times faster)
+engine_view_rows = 200 # devices shown by the emulator.py --engine viewer
 
 # Meters consuption limits"
 
 ## insted of Sensitivity max
 # i switched the water_max to senstivity_max
 sensitivityMax=0.02
-Elec_max=1.8
\ No newline at end of file
+Elec_max=1.8
+
+alarm_hysteresis = 0.05 # threshold alarms clear only 5% of the limit below it (rule 'hysteresis' sets units)
+alarm_rate = 1 / 60 # tokens per sec of each alarm key's bucket (one alarm/clear message a minute)
+alarm_burst = 3 # messages an alarm key may publish at once before the rate applies
+alarm_summary_interval = 60 # sec, held back alarm messages are reported in one summary per interval
+alarm_max_age = 300 # sec; older readings (sent late from a device's spool) are stored but not run through the alarm rules
+
+# Alarm rules per device/meter name or fnmatch pattern, compiled once by rules.RuleEngine
+# type 'threshold': max and/or min - raised outside the limits, cleared back inside the hysteresis band
+# type 'hysteresis': high, low - raised above high, cleared below low
+# type 'rate': max_rate - units per sec between consecutive readings
+# type 'window': size, max and/or min - average of the last size readings
+# optional: 'msg', 'clear_msg' (the value is appended) and 'topic' (default comm_topic + 'alarm')
+alarm_rules = {
+    'SensitivityMeter': [{'type': 'threshold', 'max': sensitivityMax,
+                          'msg': 'Current Sensitivity consumption exceed the normal! '}],
+    'ElectricityMeter': [{'type': 'threshold', 'max': Elec_max,
+                          'msg': 'Current electricity consumption exceed the normal! '}],
+}
\ No newline at end of file
@@ -2,10 +2,20 @@
 # Insert data into the SafeSleep DB
 
 import paho.mqtt.client as mqtt
+import sys
 import time
 import random
+import threading
 from init import *
 import data_acquisition as da
+import sharding
+import metrics
+from ingest import IngestQueue
+from rules import RuleEngine
+from alarms import AlarmManager
+from spool import Spool, spool_path
+from agent import TopicRouter
+from payload import decode as decode_payload
 from icecream import ic
 from datetime import datetime
 
@@ -29,6 +39,8 @@ def on_connect(client, userdata, flags, rc):
     """Callback for successful connection to the broker."""
     if rc == 0:
         ic("connected OK")
+        if outbox is not None:
+            outbox.drain_async(lambda *msg: send(client, *msg), client.is_connected)
     else:
         ic("Bad connection Returned code=", rc)
 
@@ -39,21 +51,64 @@ def on_disconnect(client, userdata, flags, rc=0):
 
 
 def on_message(client, userdata, msg):
-    """Callback for receiving a message."""
-    topic = msg.topic
-    m_decode = str(msg.payload.decode("utf-8", "ignore"))
-    ic("message from: " + topic, m_decode)
-    insert_DB(topic, m_decode)
+    """Callback for receiving a message: runs in the network thread, so it only routes/enqueues."""
+    router.dispatch(msg.topic, client, msg)
+
+
+def ingest(client, msg):
+    """Queue a device message for the ingest writer."""
+    if shards > 1:
+        # sharded mode: only the topics of this shard's partition
+        if sharding.shard_of(msg.topic, shards) != shard:
+            return
+        topics[msg.topic] = topics.get(msg.topic, 0) + 1
+    received.inc()
+    if not ingest_queue.put(client, msg.topic, msg.payload, time.perf_counter()):
+        ingest_dropped.inc()
+
+
+# topic filter -> handler(client, msg); main() subscribes to these filters
+# (device telemetry is published on comm_topic/<place>/pub, see emulator.py)
+router = TopicRouter()
+router.add(comm_topic + '/#', ingest)
+
+
+# this process' partition (main() reads --shard k/N) and the topics it has handled
+shard, shards = 0, 1
+topics = {}
+
+
+def handle_message(client, topic, payload, received_at=None):
+    """Decode and store one message and evaluate its alarm rules (ingest writer thread)."""
+    if received_at is not None:
+        queue_wait.observe(time.perf_counter() - received_at)
+    with handle_seconds.time():
+        insert_DB(topic, payload, client)
+
+
+ingest_queue = IngestQueue(handle_message)
+
+# Runtime metrics, served by metrics.serve() and logged every metrics_log_interval
+# (DB write latency is recorded by data_acquisition)
+received = metrics.registry.counter('mqtt_received', 'MQTT messages received')
+ingest_dropped = metrics.registry.counter('ingest_dropped', 'Messages dropped by the ingest queue policy')
+metrics.registry.gauge('ingest_queue_depth', 'Messages waiting in the ingest queue', ingest_queue.depth)
+queue_wait = metrics.registry.histogram('ingest_wait_seconds', 'Time from MQTT receipt to the writer thread')
+handle_seconds = metrics.registry.histogram('handle_seconds', 'Parse, store and rule evaluation of one message')
+parse_seconds = metrics.registry.histogram('parse_seconds', 'Payload decoding')
+rules_seconds = metrics.registry.histogram('rules_seconds', 'Alarm rule evaluation of one reading')
+publish_seconds = metrics.registry.histogram('publish_seconds', 'MQTT publish call')
+published = metrics.registry.counter('mqtt_published', 'MQTT messages published by the manager')
 
 
 def send_msg(client, topic, message):
     """Function to send a message to a specified topic."""
     ic("Sending message: " + message)
-    client.publish(topic, message)
+    publish(client, topic, message)
 
 
-def client_init(cname):
-    """Initialize and return an MQTT client instance."""
+def client_init(cname, will=None):
+    """Initialize and return an MQTT client instance; will is an optional (topic, payload) retained last will."""
     r = random.randrange(1, 10000000)
     ID = str(cname + str(r + 21))
     client = mqtt.Client(ID, clean_session=True)  # Create new client instance
@@ -61,6 +116,8 @@ def client_init(cname):
     client.on_disconnect = on_disconnect
     client.on_log = on_log
     client.on_message = on_message
+    if will is not None:
+        client.will_set(will[0], will[1], retain=True)
 
     if username != "":
         client.username_pw_set(username, password)
@@ -70,33 +127,68 @@ def client_init(cname):
     return client
 
 
-def insert_DB(topic, m_decode):
-    """Insert data into the database based on message content."""
-    if 'DHT' in m_decode:
-        value = parse_data(m_decode)
-        if value != 'NA':
-            da.add_IOT_data(
-                m_decode.split('From: ')[1].split(' Temperature: ')[0],
-                da.timestamp(),
-                value
-            )
-    elif 'Meter' in m_decode:
-        da.add_IOT_data('ElectricityMeter', da.timestamp(),
-                        m_decode.split(' Electricity: ')[1].split(' Sensitivity: ')[0])
-        da.add_IOT_data('SensitivityMeter', da.timestamp(), m_decode.split(' Sensitivity: ')[1])
+def insert_DB(topic, payload, client=None):
+    """Insert the readings of a message (any payload.py format) into the database; with a
+    client the alarm rules are evaluated on the parsed readings right away."""
+    with parse_seconds.time():
+        name, fields = decode_payload(payload)
+    ic("message from: " + topic, name, fields)
+    readings = []
+    if 'Humidity' in fields:  # DHT
+        readings.append((name, fields['Temperature']))
+    elif 'Electricity' in fields:  # meter
+        readings.append(('ElectricityMeter', fields['Electricity']))
+        readings.append(('SensitivityMeter', fields.get('Sensitivity')))
+    # the device's sample time (version 2 payloads), so readings sent late keep their time
+    now = time.time()
+    sampled = fields.get('Time')
+    sampled = now if sampled is None else min(sampled, now)
+    updated = da.timestamp(sampled)
+    current = now - sampled < alarm_max_age
+    for name, value in readings:
+        if name is None or value is None:
+            continue
+        if client is not None and current:
+            try:
+                check_reading(client, name, updated, value)  # before the commit, so the alarm never waits on it
+            except Exception as e:  # a failed alarm must not lose the reading
+                ic('Alarm check failed for ' + name, e)
+        da.add_IOT_data(name, updated, value)
 
 
 def parse_data(m_decode):
     """Parse temperature data from the message."""
-    value = 'NA'
-    value = m_decode.split(' Temperature: ')[1].split(' Humidity: ')[0]
-    return value
+    value = decode_payload(m_decode)[1].get('Temperature')
+    return 'NA' if value is None else value
 
 
 def enable(client, topic, msg):
     """Enable or send a message to a topic."""
     ic(topic + ' ' + msg)
-    client.publish(topic, msg)
+    publish(client, topic, msg)
+
+
+# Outbound spool of this process (created by main): publishes made while disconnected are sent on reconnect
+outbox = None
+
+
+def publish(client, topic, msg, qos=0, retain=False):
+    """Publish a message, counted and timed in the metrics; spooled while the broker is unreachable
+    or older messages are still spooled."""
+    published.inc()
+    if outbox is None or (client.is_connected() and not outbox.pending()):
+        with publish_seconds.time():
+            info = client.publish(topic, msg, qos, retain)
+        if outbox is None or info.rc == mqtt.MQTT_ERR_SUCCESS:
+            return
+    outbox.put(topic, msg, qos, retain)
+    if client.is_connected():
+        outbox.drain_async(lambda *msg: send(client, *msg), client.is_connected)
+
+
+def send(client, topic, msg, qos=0, retain=False):
+    """:return: True if the client accepted the message"""
+    return client.publish(topic, msg, qos, retain).rc == mqtt.MQTT_ERR_SUCCESS
 
 
 def alarm(client, topic, msg):
@@ -110,58 +202,108 @@ def actuator(client, topic, msg):
     enable(client, topic, msg)
 
 
-def check_DB_for_change(client):
-    """Check the database for changes and publish alerts if thresholds are exceeded."""
-    df = da.fetch_data(db_name, 'data', 'SensitivityMeter')
+# Alarm rules of init.alarm_rules, compiled once, and the raised/cleared state of each alarm
+rule_engine = RuleEngine()
+alarms = None
+alarms_lock = threading.Lock()  # the ingest writer and the main thread's fallback poll both create it on first use
 
-    if len(df.value) == 0:
-        return
+# meter name -> timestamp of the last reading evaluated by the rules
+evaluated = {}
 
-    if float(df.value[-1]) > sensitivityMax:
-        msg = 'Current Sensitivity consumption exceed the normal! ' + df.value[-1]
-        ic(msg)
-        client.publish(comm_topic + 'alarm', msg)
 
-    df = da.fetch_data(db_name, 'data', 'ElectricityMeter')
-    if len(df.value) == 0:
-        return
-    if float(df.value[-1]) > Elec_max:
-        msg = 'Current electricity consumption exceed the normal! ' + df.value[-1]
-        ic(msg)
-        client.publish(comm_topic + 'alarm', msg)
+def check_reading(client, name, updated, value):
+    """Run the device's rules on a freshly parsed reading; raised/cleared transitions are published at once."""
+    global alarms
+    if alarms is None:
+        with alarms_lock:
+            if alarms is None:
+                alarms = AlarmManager(lambda topic, msg: publish(client, topic, msg))
+    evaluated[name] = updated
+    with rules_seconds.time():
+        results = rule_engine.evaluate(name, da.to_epoch(updated), da.to_real(value))
+    for key, state, topic, msg in results:
+        alarms.update(key, state, topic, msg)
+
+
+def check_DB_for_change(client):
+    """Fallback rule check of the latest stored readings; readings already
+    evaluated by check_reading are skipped, and so are readings older than alarm_max_age
+    (stored late from a device's spool), as in insert_DB."""
+    now = da.to_epoch(da.timestamp())  # stored timestamps are local wall-clock time
+    for name in rule_engine.names():
+        latest = da.get_latest(name)
+        if latest is None or latest[0] == evaluated.get(name):
+            continue
+        if now - da.to_epoch(latest[0]) >= alarm_max_age:
+            continue
+        check_reading(client, name, *latest)
 
 
 def check_Data(client):
-    """Check the data for changes and send commands if necessary."""
+    """Process new device changes from the change log and send commands if necessary."""
     try:
-        rrows = da.check_changes('iot_devices')
-        for row in rrows:
-            topic = row[17]
-            if row[10] == 'alarm':
-                msg = 'Set temperature to: ' + str(row[15])
+        rrows = da.read_changes('manager')
+        for seq, sys_id, name, state, temperature, topic in rrows:
+            if state == 'alarm':
+                msg = 'Set temperature to: ' + str(temperature)
                 alarm(client, topic, msg)
-                da.update_IOT_status(int(row[0]))
             else:
                 msg = 'actuated'
                 actuator(client, topic, msg)
-    except:
-        pass
-
-
-def main():
-    """Main function to initialize client and start monitoring loop."""
-    cname = "Manager-"
-    client = client_init(cname)
+            da.ack_changes(seq, 'manager')
+        if rrows:
+            da.prune_changes()
+    except Exception as e:
+        ic(e)
+
+
+def main(shard_no=0, shard_count=1):
+    """Main function to initialize client and start monitoring loop.
+    With shard_count > 1 this process handles only the device topics of partition shard_no;
+    shard 0 also runs the singleton jobs (change log, DB maintenance)."""
+    global shard, shards, outbox
+    shard, shards = shard_no, shard_count
+    outbox = Spool(spool_path('manager' if shards == 1 else 'manager-' + str(shard)))
+    cname = "Manager-" if shards == 1 else "Manager-" + str(shard) + "-"
+    heartbeat_topic = sharding.shard_topic + str(shard)
+    da.init_db(db_name)  # Create/migrate the DB schema before any insert
+    ingest_queue.start()
+    metrics_server = metrics.serve(metrics_port + shard if metrics_port else 0)  # one port per shard
+    client = client_init(cname, will=(heartbeat_topic, sharding.heartbeat(shard, shards, {}, alive=False))
+                         if shards > 1 else None)
 
     # Start the MQTT client loop and subscribe to topics
     client.loop_start()
-    client.subscribe(comm_topic + '#')
+    for topic_filter in router.filters():
+        client.subscribe(topic_filter)
 
+    last_maintenance = last_report = last_poll = last_beat = time.time() - db_maintenance_interval
+    last_metrics = time.time()
     try:
         while conn_time == 0:
-            check_DB_for_change(client)
+            if shards == 1 and time.time() - last_poll >= threshold_poll_interval:
+                check_DB_for_change(client)  # fallback, the rules run on ingest
+                last_poll = time.time()
             time.sleep(conn_time + manag_time)
-            check_Data(client)
+            if shard == 0:
+                check_Data(client)
+                if db_wal_autocheckpoint == 0:
+                    da.checkpoint()
+            if alarms is not None:
+                alarms.flush_due()  # summaries of held back alarms
+            if shard == 0 and time.time() - last_maintenance >= db_maintenance_interval:
+                da.maintain_partitions()  # inbox, archive compaction and retention
+                last_maintenance = time.time()
+            if time.time() - last_report >= ingest_report_interval:
+                ingest_queue.report()
+                last_report = time.time()
+            if time.time() - last_metrics >= metrics_log_interval:
+                ic('metrics', metrics.registry.summary())
+                last_metrics = time.time()
+            if shards > 1 and time.time() - last_beat >= shard_heartbeat_interval:
+                last_beat = time.time()
+                publish(client, heartbeat_topic,
+                        sharding.heartbeat(shard, shards, dict(topics), ingest_queue.stats()), retain=True)
             time.sleep(3)
         ic("con_time ending")
     except KeyboardInterrupt:
@@ -170,8 +312,14 @@ def main():
 
     client.loop_stop()  # Stop the MQTT client loop
     client.disconnect()  # Disconnect from broker
+    ingest_queue.stop()  # Write the queued messages
+    da.flush_IOT_data()  # Write buffered readings
+    da.close_connections()  # Close pooled DB connections
+    outbox.close()  # Undelivered messages stay spooled for the next run
+    if metrics_server is not None:
+        metrics_server.shutdown()
     ic("End manager run script")
 
 
 if __name__ == "__main__":
-    main()
+    main(*sharding.parse_shard(sys.argv))
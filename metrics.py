@@ -0,0 +1,240 @@
+# Runtime metrics of the manager
+# An in-process registry of counters, gauges and latency histograms, exposed in the Prometheus
+# text format on a local HTTP endpoint (http://127.0.0.1:<metrics_port>/metrics) and summarized
+# in a periodic log line. Recording is a lock and a few integer operations, so it can stay on
+# the per-message path.
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from init import *
+
+
+class Counter:
+    """Monotonic counter."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name + '_total', self.value)]
+
+    def summary(self, period, previous):
+        rate = (self.value - previous) / period if period > 0 else 0.0
+        return f'{self.name} {self.value} ({rate:.1f}/s)', self.value
+
+
+class Gauge:
+    """Current value, either set() by the code or read from a callback at collection time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+    def samples(self):
+        return [(self.name, self.get())]
+
+    def summary(self, period, previous):
+        return f'{self.name} {self.get()}', None
+
+
+class Histogram:
+    """
+    HDR-style latency histogram: values are recorded in microseconds into log-linear buckets
+    (16 sub-buckets per power of two, so quantiles are within ~6%), with memory bounded by the
+    value range rather than the number of recordings. Exposed as a Prometheus summary.
+    """
+
+    kind = 'summary'
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(us):
+        """
+        :return: bucket index of an integer microsecond value
+        """
+        if us < 32:
+            return us
+        shift = us.bit_length() - 5
+        return shift * 16 + (us >> shift)
+
+    @staticmethod
+    def bucket_value(index):
+        """
+        :return: upper bound (microseconds) of a bucket
+        """
+        if index < 32:
+            return index
+        shift = (index - 16) // 16
+        return ((index - 16 * shift + 1) << shift) - 1
+
+    def observe(self, seconds):
+        """
+        Record one duration in seconds.
+        """
+        index = self.bucket(int(seconds * 1e6))
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        """
+        usage: with histogram.time(): ...
+        """
+        return Timer(self)
+
+    def quantile(self, q):
+        """
+        :return: q-quantile in seconds (bucket upper bound), 0.0 without recordings
+        """
+        with self._lock:
+            counts, total = sorted(self.counts.items()), self.count
+        rank, seen = q * total, 0
+        for index, n in counts:
+            seen += n
+            if seen >= rank:
+                return self.bucket_value(index) / 1e6
+        return 0.0
+
+    def samples(self):
+        rows = [(self.name + '{quantile="' + str(q) + '"}', self.quantile(q)) for q in self.quantiles]
+        return rows + [(self.name + '_sum', self.sum), (self.name + '_count', self.count)]
+
+    def summary(self, period, previous):
+        return (f'{self.name} n={self.count} p50={self.quantile(0.5) * 1e3:.2f}ms '
+                f'p99={self.quantile(0.99) * 1e3:.2f}ms max={self.max * 1e3:.2f}ms'), None
+
+
+class Timer:
+    """Context manager recording the elapsed time into a Histogram."""
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    """
+    Named metrics of the process.
+    usage: rx = registry.counter('mqtt_received', 'Messages received'); rx.inc()
+    """
+
+    def __init__(self, prefix=metrics_prefix):
+        self.prefix = prefix
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._last = (time.monotonic(), {})
+
+    def _get(self, cls, name, help_text, *args):
+        name = self.prefix + name
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, *args)
+            return metric
+
+    def counter(self, name, help_text=''):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text='', func=None):
+        return self._get(Gauge, name, help_text, func)
+
+    def histogram(self, name, help_text=''):
+        return self._get(Histogram, name, help_text)
+
+    def exposition(self):
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            if metric.help:
+                lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+            lines += [name + ' ' + repr(float(value)) for name, value in metric.samples()]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: one log line with every metric, counter rates since the previous summary
+        """
+        now = time.monotonic()
+        started, previous = self._last
+        parts, values = [], {}
+        for metric in list(self.metrics.values()):
+            text, value = metric.summary(now - started, previous.get(metric.name, 0))
+            parts.append(text[len(self.prefix):] if text.startswith(self.prefix) else text)
+            if value is not None:
+                values[metric.name] = value
+        self._last = (now, values)
+        return ', '.join(parts)
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no log line per scrape
+
+
+def serve(port=metrics_port, host=metrics_host):
+    """
+    Start the metrics HTTP endpoint in a daemon thread.
+    :return: the server (server.shutdown() stops it), None when port is 0
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,315 @@
+# Minimal in-process MQTT 3.1.1 broker for offline tests, soak runs and benchmarks
+# usage: python mini_broker.py [port]           (select it in init.py with nb = 3)
+#        broker, thread = start_in_thread(port)  (from a test/benchmark process)
+# Supported: CONNECT (clean and persistent sessions - subscriptions only, last will, user/password
+# accepted), SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PUBLISH QoS 0 and 1 (QoS 2 is
+# acknowledged and delivered at QoS 1), retained messages, PINGREQ, DISCONNECT and keepalive
+# timeouts. Not supported: authentication, offline message queues and redelivery.
+import sys
+import struct
+import asyncio
+import threading
+from init import *
+from agent import TopicRouter
+from icecream import ic
+from datetime import datetime
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def packet(kind, flags, body=b''):
+    """
+    :return: MQTT packet: fixed header (type, flags, remaining length) + body
+    """
+    head, size = bytearray([kind << 4 | flags]), len(body)
+    while True:
+        byte, size = size & 0x7F, size >> 7
+        head.append(byte | 0x80 if size else byte)
+        if not size:
+            return bytes(head) + body
+
+
+def string(data):
+    """
+    :return: MQTT length-prefixed string of bytes/str
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def read_string(body, offset):
+    """
+    :return: tuple (bytes, offset after the string)
+    """
+    size = struct.unpack_from('!H', body, offset)[0]
+    return body[offset + 2:offset + 2 + size], offset + 2 + size
+
+
+class Subscription:
+    """One topic filter of a session; the TopicRouter 'handler' of the broker."""
+
+    __slots__ = ('session', 'topic_filter', 'qos')
+
+    def __init__(self, session, topic_filter, qos):
+        self.session = session
+        self.topic_filter = topic_filter
+        self.qos = qos
+
+
+class Session:
+    """Client state: connection, subscriptions (kept for persistent sessions) and last will."""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.writer = None
+        self.subscriptions = {}  # topic filter -> Subscription
+        self.will = None  # (topic, payload, qos, retain)
+        self.clean = True
+        self.next_id = 0
+        self.dropped = 0
+
+    def send(self, data):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def packet_id(self):
+        self.next_id = self.next_id % 0xFFFF + 1
+        return self.next_id
+
+
+class MiniBroker:
+    """
+    asyncio MQTT 3.1.1 broker.
+    usage: broker = MiniBroker(); await broker.start(); ... await broker.stop()
+    """
+
+    def __init__(self, host=local_broker_host, port=local_broker_port, max_buffer=local_broker_max_buffer):
+        """
+        :param max_buffer: bytes a slow subscriber may have unsent before its QoS 0 messages are dropped
+        """
+        self.host = host
+        self.port = int(port)
+        self.max_buffer = max_buffer
+        self.router = TopicRouter()
+        self.sessions = {}  # client id -> Session (connected ones and persistent ones)
+        self.retained = {}  # topic -> (payload, qos)
+        self.server = None
+        self.received = self.delivered = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        ic(f"MQTT broker listening on {self.host}:{self.port}")
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for session in list(self.sessions.values()):
+            if session.writer is not None:
+                session.writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        session, graceful = None, False
+        try:
+            kind, flags, body = await self.read_packet(reader, None)
+            if kind != CONNECT:
+                return
+            session, keepalive = self.connect(body, writer)
+            if session is None:
+                return
+            timeout = keepalive * 1.5 if keepalive else None
+            while True:
+                kind, flags, body = await self.read_packet(reader, timeout)
+                if kind == PUBLISH:
+                    self.on_publish(session, flags, body)
+                elif kind == SUBSCRIBE:
+                    self.on_subscribe(session, body)
+                elif kind == UNSUBSCRIBE:
+                    self.on_unsubscribe(session, body)
+                elif kind == PUBREL:
+                    session.send(packet(PUBCOMP, 0, body[:2]))
+                elif kind == PINGREQ:
+                    session.send(packet(PINGRESP, 0))
+                elif kind == DISCONNECT:
+                    graceful = True
+                    return
+                # PUBACK/PUBREC/PUBCOMP of our deliveries: nothing is redelivered, so nothing to do
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, struct.error, ValueError):
+            pass
+        finally:
+            writer.close()
+            if session is not None and session.writer is writer:
+                self.disconnected(session, graceful)
+
+    async def read_packet(self, reader, timeout):
+        """
+        :return: tuple (packet type, flags, body)
+        """
+        first = await asyncio.wait_for(reader.readexactly(1), timeout)
+        size, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            size |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift > 21:
+                raise ValueError('Malformed remaining length')
+        body = await reader.readexactly(size) if size else b''
+        return first[0] >> 4, first[0] & 0x0F, body
+
+    def connect(self, body, writer):
+        """
+        Handle CONNECT: take over/restore the session and answer CONNACK.
+        :return: tuple (Session or None when refused, keepalive sec)
+        """
+        name, offset = read_string(body, 0)
+        level, flags, keepalive = struct.unpack_from('!BBH', body, offset)
+        offset += 4
+        if (name, level) not in ((b'MQTT', 4), (b'MQIsdp', 3)):
+            writer.write(packet(CONNACK, 0, b'\x00\x01'))  # unacceptable protocol version
+            return None, 0
+        client_id, offset = read_string(body, offset)
+        client_id = client_id.decode('utf-8') or 'auto-' + str(id(writer))
+        will = None
+        if flags & 0x04:
+            will_topic, offset = read_string(body, offset)
+            will_payload, offset = read_string(body, offset)
+            will = (will_topic.decode('utf-8'), will_payload, flags >> 3 & 0x03, bool(flags & 0x20))
+        clean = bool(flags & 0x02)
+        session = self.sessions.get(client_id)
+        if session is not None and session.writer is not None:
+            session.writer.close()  # a new connection with the same id takes over
+            session.writer = None
+        present = session is not None and not clean and not session.clean
+        if session is None or clean:
+            if session is not None:
+                self.drop_subscriptions(session)
+            session = self.sessions[client_id] = Session(client_id)
+        session.writer, session.will, session.clean = writer, will, clean
+        session.send(packet(CONNACK, 0, bytes([int(present), 0])))
+        return session, keepalive
+
+    def disconnected(self, session, graceful):
+        session.writer = None
+        will, session.will = session.will, None
+        if will is not None and not graceful:
+            self.deliver(*will)
+        if session.clean:
+            self.drop_subscriptions(session)
+            self.sessions.pop(session.client_id, None)
+
+    def drop_subscriptions(self, session):
+        for sub in session.subscriptions.values():
+            self.router.remove(sub.topic_filter, sub)
+        session.subscriptions = {}
+
+    def on_publish(self, session, flags, body):
+        topic, offset = read_string(body, 0)
+        qos = flags >> 1 & 0x03
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.send(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+        self.deliver(topic.decode('utf-8'), body[offset:], qos, bool(flags & 0x01))
+
+    def deliver(self, topic, data, qos=0, retain=False):
+        """
+        Route one message to the matching subscriptions (and the retained store).
+        """
+        self.received += 1
+        if retain:
+            if data:
+                self.retained[topic] = (data, qos)
+            else:
+                self.retained.pop(topic, None)
+        targets = {}
+        for sub in self.router.match(topic):
+            targets[sub.session] = max(targets.get(sub.session, 0), sub.qos)
+        for session, sub_qos in targets.items():
+            self.send_publish(session, topic, data, min(qos, sub_qos, 1), False)
+
+    def send_publish(self, session, topic, data, qos, retain):
+        writer = session.writer
+        if writer is None:
+            return
+        if qos == 0 and writer.transport.get_write_buffer_size() > self.max_buffer:
+            session.dropped += 1  # slow subscriber
+            return
+        body = string(topic) + (struct.pack('!H', session.packet_id()) if qos else b'') + data
+        session.send(packet(PUBLISH, qos << 1 | int(retain), body))
+        self.delivered += 1
+
+    def on_subscribe(self, session, body):
+        packet_id, offset = body[:2], 2
+        granted, filters = bytearray(), []
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            topic_filter, qos = topic_filter.decode('utf-8'), min(body[offset] & 0x03, 1)
+            offset += 1
+            old = session.subscriptions.pop(topic_filter, None)
+            if old is not None:
+                self.router.remove(topic_filter, old)
+            try:
+                sub = Subscription(session, topic_filter, qos)
+                self.router.add(topic_filter, sub)
+            except ValueError:
+                granted.append(0x80)  # invalid filter
+                continue
+            session.subscriptions[topic_filter] = sub
+            granted.append(qos)
+            filters.append(sub)
+        session.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+        for sub in filters:
+            matcher = TopicRouter()
+            matcher.add(sub.topic_filter, sub)
+            for topic, (data, qos) in list(self.retained.items()):
+                if matcher.match(topic):
+                    self.send_publish(session, topic, data, min(qos, sub.qos), True)
+
+    def on_unsubscribe(self, session, body):
+        packet_id, offset = body[:2], 2
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            sub = session.subscriptions.pop(topic_filter.decode('utf-8'), None)
+            if sub is not None:
+                self.router.remove(sub.topic_filter, sub)
+        session.send(packet(UNSUBACK, 0, packet_id))
+
+
+def start_in_thread(port=local_broker_port, host=local_broker_host):
+    """
+    Run a MiniBroker on its own event loop in a daemon thread (tests and benchmarks).
+    :return: tuple (broker, thread), once the broker is listening
+    """
+    broker = MiniBroker(host, port)
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(broker.start())
+        ready.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, name='mini-broker', daemon=True)
+    thread.start()
+    ready.wait()
+    return broker, thread
+
+
+async def main(port):
+    broker = await MiniBroker(port=port).start()
+    async with broker.server:
+        await broker.server.serve_forever()
+
+
+if __name__ == '__main__':
+    ic.configureOutput(prefix=lambda: f'{datetime.now()}  Broker|> ', includeContext=False)
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else local_broker_port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,134 @@
+# Telemetry payload format shared by the emulators, the manager and the GUI
+# Version 1 payloads come in two encodings, chosen by init.payload_format:
+#   json   - {"v":1,"k":"dht","d":"DHT-1","r":[25.0,80.0]}
+#   struct - header '<BBB' (0x80 | version, kind code, name length), utf-8 name, one '<d' per field
+# and 'text' keeps the legacy 'From: DHT-1 Temperature: 25 Humidity: 80' strings.
+# Version 2 adds the sample time (epoch sec): "t" in json, one more '<d' after the fields in
+# struct, a 'Time: ...' pair in text. A reading sent late (e.g. from a device's spool) keeps it.
+# decode() reads all of them in a single pass and always returns (device name, {field: value}),
+# with the sample time as field 'Time' when the payload has one.
+import json
+import struct
+from init import *
+
+payload_version = 1
+timed_version = 2  # payload_version + sample time
+
+# kind -> (code in the struct header, fields in payload order)
+kinds = {
+    'dht': (1, ('Temperature', 'Humidity')),
+    'meter': (2, ('Electricity', 'Sensitivity')),
+    'motion': (3, ('Temperature',)),
+}
+kind_codes = {code: (kind, fields) for kind, (code, fields) in kinds.items()}
+
+header = struct.Struct('<BBB')
+# (kind code, name length, timed) -> Struct of the whole message, built on first use
+message_structs = {}
+
+
+def message_struct(code, size, timed=False):
+    """
+    :return: Struct packing header, name, fields (and sample time) of a message in one call
+    """
+    packer = message_structs.get((code, size, timed))
+    if packer is None:
+        count = len(kind_codes[code][1]) + timed
+        packer = message_structs[(code, size, timed)] = struct.Struct('<BBB%ds%dd' % (size, count))
+    return packer
+
+
+def encode(kind, name, values, fmt=None, ts=None):
+    """
+    Build a version 1 payload, version 2 with a sample time.
+    :param kind: key of kinds ('dht', 'meter', 'motion')
+    :param name: device name
+    :param values: field values in the order of kinds[kind]
+    :param fmt: 'json', 'struct' or 'text', init.payload_format by default
+    :param ts: sample time (epoch sec), None for none
+    :return: payload as bytes (struct) or str
+    """
+    fmt = fmt or payload_format
+    code, fields = kinds[kind]
+    version = payload_version if ts is None else timed_version
+    if fmt == 'struct':
+        raw = name.encode('utf-8')
+        extra = () if ts is None else (ts,)
+        return message_struct(code, len(raw), ts is not None).pack(0x80 | version, code, len(raw), raw,
+                                                                    *values, *extra)
+    if fmt == 'json':
+        msg = {'v': version, 'k': kind, 'd': name, 'r': list(values)}
+        if ts is not None:
+            msg['t'] = ts
+        return json.dumps(msg, separators=(',', ':'))
+    # legacy text; the motion sensor never sent its name
+    text = ' '.join(field + ': ' + str(value) for field, value in zip(fields, values))
+    if ts is not None:
+        text += ' Time: ' + repr(float(ts))
+    return text if kind == 'motion' else 'From: ' + name + ' ' + text
+
+
+def decode(payload):
+    """
+    Decode a payload of any version/encoding.
+    :param payload: message payload (bytes or str)
+    :return: tuple (device name or None, dict field -> float, None when not numeric);
+             (None, {}) for a payload that is not telemetry
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        if payload[:1] and payload[0] & 0x80:
+            return decode_struct(payload)
+        payload = payload.decode('utf-8', 'ignore')
+    if payload[:1] == '{':
+        try:
+            msg = json.loads(payload)
+            fields = kinds[msg['k']][1]
+            values = {field: to_float(value) for field, value in zip(fields, msg['r'])}
+            if 't' in msg:
+                values['Time'] = to_float(msg['t'])
+            return msg['d'], values
+        except (ValueError, KeyError, TypeError):
+            return None, {}
+    # legacy text: 'Key: value' token pairs
+    tokens = payload.split()
+    name, fields = None, {}
+    for key, value in zip(tokens[::2], tokens[1::2]):
+        if key == 'From:':
+            name = value
+        elif key[-1:] == ':':
+            fields[key[:-1]] = to_float(value)
+    return name, fields
+
+
+def decode_struct(payload):
+    """
+    :return: decode() result of a struct-packed payload
+    """
+    try:
+        flags, code, size = header.unpack_from(payload)
+        timed = flags & 0x7F == timed_version
+        values = message_struct(code, size, timed).unpack_from(payload)
+        fields = dict(zip(kind_codes[code][1], values[4:]))
+        if timed:
+            fields['Time'] = values[-1]
+        return values[3].decode('utf-8'), fields
+    except (struct.error, KeyError, UnicodeDecodeError):
+        return None, {}
+
+
+def to_float(value):
+    """
+    :return: float value, None if it is not numeric
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def text(fields, field):
+    """
+    Display form of a decoded field: '25', '2.45', or 'NA' when missing.
+    """
+    value = fields.get(field)
+    return 'NA' if value is None else format(value, 'g')
@@ -0,0 +1,306 @@
+# Record and replay MQTT traffic, the load baseline for performance changes
+# usage:
+#   python replay.py record-mqtt FILE [seconds] [--filter=pr/SafeSleep/#]   capture a live subscription
+#   python replay.py record-db FILE [start_date end_date]                   rebuild the stream from the data table
+#   python replay.py play FILE [--speed=N|max] [--broker] [--sync] [--db=path]
+# play feeds the recording into the manager at N x the recorded pace (1 by default, 'max' - no pauses):
+#   default  - manager.on_message, i.e. the ingest queue and its writer thread, in this process
+#   --sync   - manager.insert_DB called directly by the player (no queue)
+#   --broker - published to the broker and received by an in-process manager client
+# and reports the throughput and the end-to-end latency (send -> stored and rules evaluated).
+# Recording file: b'SSREC1\n', then records '<dHI' (epoch ts, topic id, payload length) + payload;
+# topic id 0xFFFF defines the next topic id with the topic name as payload. FILE.gz is gzipped.
+import sys
+import gzip
+import math
+import time
+import random
+import struct
+import threading
+from collections import defaultdict, deque
+import paho.mqtt.client as mqtt
+from init import *
+import data_acquisition as da
+import metrics
+import payload
+
+magic = b'SSREC1\n'
+record = struct.Struct('<dHI')
+topic_record = 0xFFFF
+
+
+def open_file(path, mode):
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+
+class Recorder:
+    """
+    Append (ts, topic, payload) records to a recording file.
+    usage: with Recorder(path) as rec: rec.write(time.time(), topic, payload)
+    """
+
+    def __init__(self, path):
+        self.file = open_file(path, 'wb')
+        self.file.write(magic)
+        self.topics = {}
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, ts, topic, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._lock:
+            topic_id = self.topics.get(topic)
+            if topic_id is None:
+                name = topic.encode('utf-8')
+                topic_id = self.topics[topic] = len(self.topics)
+                self.file.write(record.pack(ts, topic_record, len(name)) + name)
+            self.file.write(record.pack(ts, topic_id, len(data)) + data)
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_recording(path):
+    """
+    :return: iterator over the (ts, topic, payload bytes) records of a recording file
+    """
+    with open_file(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(path + ' is not a recording')
+        topics = []
+        while True:
+            head = f.read(record.size)
+            if len(head) < record.size:
+                return
+            ts, topic_id, size = record.unpack(head)
+            data = f.read(size)
+            if topic_id == topic_record:
+                topics.append(data.decode('utf-8'))
+            else:
+                yield ts, topics[topic_id], data
+
+
+def record_mqtt(path, seconds=None, topic_filter=comm_topic + '/#'):
+    """
+    Record a live subscription until seconds elapse or Ctrl-C.
+    :return: number of recorded messages
+    """
+    with Recorder(path) as rec:
+        client = mqtt.Client('Recorder-' + str(random.randrange(1, 10000000)), clean_session=True)
+        client.on_message = lambda c, userdata, msg: rec.write(time.time(), msg.topic, msg.payload)
+        if username != "":
+            client.username_pw_set(username, password)
+        client.connect(broker_ip, int(port))
+        client.subscribe(topic_filter)
+        client.loop_start()
+        try:
+            if seconds:
+                time.sleep(seconds)
+            else:
+                threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        client.loop_stop()
+        client.disconnect()
+        return rec.count
+
+
+def record_db(path, start_date=None, end_date=None):
+    """
+    Rebuild the message stream of a time range from the data table: the Electricity/Sensitivity
+    readings of one timestamp become one meter message, every other reading a DHT message
+    of its meter, on the topic comm_topic/<meter name>/pub.
+    :return: number of recorded messages
+    """
+    lo = da.to_epoch(start_date) if start_date else None
+    hi = da.to_epoch(end_date) if end_date else None
+    conn = da.get_connection()
+    cur = conn.cursor()
+    where = ' WHERE s.ts BETWEEN ? AND ?' if lo is not None else ''
+    cur.execute(*da.union_sql("SELECT m.name, s.ts, s.value FROM meters m CROSS JOIN {table} s ON s.device_id = m.id"
+                              + where, da.partition_sources(conn, lo, hi), (lo, hi) if where else (), ' ORDER BY 2'))
+    with Recorder(path) as rec:
+        meter = {}
+
+        def write_meter(ts):
+            if len(meter) == 2:
+                rec.write(ts, comm_topic + '/Home/pub', payload.encode(
+                    'meter', 'ElecSensitivityMeter', (meter['ElectricityMeter'], meter['SensitivityMeter'])))
+            else:
+                for name, value in meter.items():
+                    write_reading(ts, name, value)
+            meter.clear()
+
+        def write_reading(ts, name, value):
+            rec.write(ts, comm_topic + '/' + name + '/pub', payload.encode('dht', name, (value, math.nan)))
+
+        last_ts = None
+        for name, ts, value in da.iter_cursor(cur):
+            if meter and ts != last_ts:
+                write_meter(last_ts)
+            last_ts = ts
+            if value is None:
+                continue
+            if name in ('ElectricityMeter', 'SensitivityMeter'):
+                meter[name] = value
+            else:
+                write_reading(ts, name, value)
+        if meter:
+            write_meter(last_ts)
+        return rec.count
+
+
+class Message:
+    """The part of paho's MQTTMessage the manager reads."""
+
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, data):
+        self.topic = topic
+        self.payload = data
+
+
+class Sink:
+    """Stand-in MQTT client of the manager in direct mode: counts what it would publish."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, msg, qos=0, retain=False):
+        """
+        :return: paho-like result of an accepted publish
+        """
+        self.published += 1
+        return mqtt.MQTTMessageInfo(self.published)
+
+    def is_connected(self):
+        return True
+
+
+def paced(records, speed):
+    """
+    Yield the records at speed x their recorded pace (None - as fast as possible).
+    """
+    started = first = None
+    for ts, topic, data in records:
+        if speed is not None:
+            if first is None:
+                started, first = time.perf_counter(), ts
+            delay = started + (ts - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield ts, topic, data
+
+
+def play(path, speed=1.0, mode='queue'):
+    """
+    Replay a recording into the manager.
+    :param speed: pace factor, None for max speed
+    :param mode: 'queue' (manager.on_message), 'sync' (manager.insert_DB) or 'broker'
+    :return: dict with the counts, throughput and latency percentiles (ms)
+    """
+    import manager
+    da.init_db(da.db_name)
+    latency = metrics.Histogram('replay_latency_seconds', '')
+    sent = defaultdict(deque)  # broker mode: topic -> send times of the messages in flight
+    handled = [0]
+    handler = manager.ingest_queue.handler
+
+    def measured(client, topic, data, received_at=None):
+        handler(client, topic, data, received_at)
+        done = time.perf_counter()
+        started = sent[topic].popleft() if mode == 'broker' and sent[topic] else received_at
+        if started is not None:
+            latency.observe(done - started)
+        handled[0] += 1
+
+    manager.ingest_queue.handler = measured
+    manager.ingest_queue.start()
+    if mode == 'broker':
+        client = manager.client_init('Replay-Manager-')
+        client.subscribe(comm_topic + '/#', qos=1)
+        client.loop_start()
+        publisher = mqtt.Client('Replay-' + str(random.randrange(1, 10000000)), clean_session=True)
+        if username != "":
+            publisher.username_pw_set(username, password)
+        publisher.connect(broker_ip, int(port))
+        publisher.loop_start()
+    else:
+        client = Sink()
+    count = 0
+    started = time.perf_counter()
+    for ts, topic, data in paced(read_recording(path), speed):
+        if mode == 'sync':
+            t0 = time.perf_counter()
+            manager.insert_DB(topic, data, client)
+            latency.observe(time.perf_counter() - t0)
+            handled[0] += 1
+        elif mode == 'broker':
+            sent[topic].append(time.perf_counter())
+            publisher.publish(topic, data, qos=1)
+        else:
+            manager.on_message(client, None, Message(topic, data))
+        count += 1
+    sending = time.perf_counter() - started
+    if mode == 'broker':
+        idle, last = time.perf_counter(), handled[0]
+        while handled[0] < count and time.perf_counter() - idle < 5:
+            time.sleep(0.05)
+            if handled[0] != last:
+                idle, last = time.perf_counter(), handled[0]
+    manager.ingest_queue.stop()  # drain what is queued
+    da.flush_IOT_data()
+    elapsed = time.perf_counter() - started
+    if mode == 'broker':
+        client.loop_stop()
+        client.disconnect()
+        publisher.loop_stop()
+        publisher.disconnect()
+    manager.ingest_queue.handler = handler
+    return {'mode': mode, 'sent': count, 'handled': handled[0], 'send_rate': count / sending if sending else 0.0,
+            'rate': handled[0] / elapsed if elapsed else 0.0, 'elapsed': elapsed,
+            'p50': latency.quantile(0.5) * 1e3, 'p99': latency.quantile(0.99) * 1e3, 'max': latency.max * 1e3}
+
+
+def option(name, default=None):
+    """
+    :return: value of a --name=value argument
+    """
+    for arg in sys.argv[2:]:
+        if arg.startswith('--' + name + '='):
+            return arg.split('=', 1)[1]
+    return default
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) < 2:
+        print('usage: python replay.py record-mqtt|record-db|play FILE ...')
+        sys.exit(1)
+    command, path = args[0], args[1]
+    if option('db'):
+        da.db_name = option('db')
+    if command == 'record-mqtt':
+        print('recorded', record_mqtt(path, float(args[2]) if len(args) > 2 else None,
+                                      option('filter', comm_topic + '/#')), 'messages')
+    elif command == 'record-db':
+        print('recorded', record_db(path, *args[2:4]), 'messages')
+    elif command == 'play':
+        speed = option('speed', '1')
+        mode = 'broker' if '--broker' in sys.argv else 'sync' if '--sync' in sys.argv else 'queue'
+        r = play(path, None if speed == 'max' else float(speed), mode)
+        print(f"{r['mode']}: {r['handled']}/{r['sent']} messages in {r['elapsed']:.2f}s, "
+              f"sent {r['send_rate']:.0f}/s, handled {r['rate']:.0f}/s, "
+              f"latency p50 {r['p50']:.2f}ms p99 {r['p99']:.2f}ms max {r['max']:.2f}ms")
+        print(metrics.registry.summary())
+    else:
+        print('Unknown command: ' + command)
+        sys.exit(1)
@@ -0,0 +1,184 @@
+# Alarm rule engine
+# Rules are declared per device/meter name in init.alarm_rules and compiled once into small
+# evaluator objects. Every reading only runs the evaluators of its own device, and each
+# evaluator updates its state incrementally (previous reading, running window sum), so the cost
+# per reading is O(rules of that device) however many rules are loaded. The evaluators report
+# the alarm condition per reading; alarms.AlarmManager decides what is actually published.
+import threading
+from collections import deque
+from fnmatch import fnmatchcase
+from init import *
+
+
+class Rule:
+    """
+    Base of the compiled rules. check() gets every reading of the device in time order and
+    tells whether the alarm condition holds; alarms.AlarmManager turns that into raise/clear events.
+    """
+
+    kind = 'rule'
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.msg = spec.get('msg', name + ' alarm: ')
+        self.clear_msg = spec.get('clear_msg', name + ' back to normal: ')
+        self.topic = spec.get('topic', comm_topic + 'alarm')
+
+    def check(self, ts, value):
+        """
+        :param ts: epoch seconds of the reading
+        :param value: reading as float
+        :return: tuple (state, detail) - state True: alarm condition, False: clear condition,
+                 None: unchanged (inside the hysteresis band or not enough readings yet)
+        """
+        raise NotImplementedError
+
+
+class Threshold(Rule):
+    """Alarm above 'max' or below 'min', cleared once the reading is back by more than the
+    hysteresis band ('hysteresis' in units, alarm_hysteresis of the limit by default)."""
+
+    kind = 'threshold'
+
+    def __init__(self, name, spec):
+        super().__init__(name, spec)
+        self.max = spec.get('max')
+        self.min = spec.get('min')
+        self.band = spec.get('hysteresis')
+
+    def margin(self, limit):
+        return self.band if self.band is not None else abs(limit) * alarm_hysteresis
+
+    def check(self, ts, value):
+        if (self.max is not None and value > self.max) or (self.min is not None and value < self.min):
+            return True, str(value)
+        if (self.max is not None and value > self.max - self.margin(self.max)) or \
+                (self.min is not None and value < self.min + self.margin(self.min)):
+            return None, str(value)
+        return False, str(value)
+
+
+class Hysteresis(Rule):
+    """Alarm above 'high', cleared only below 'low'."""
+
+    kind = 'hysteresis'
+
+    def __init__(self, name, spec):
+        super().__init__(name, spec)
+        self.high = spec['high']
+        self.low = spec.get('low', spec['high'])
+
+    def check(self, ts, value):
+        if value > self.high:
+            return True, str(value)
+        if value < self.low:
+            return False, str(value)
+        return None, str(value)
+
+
+class Rate(Rule):
+    """Alarm while the reading changes faster than 'max_rate' units per sec since the previous one."""
+
+    kind = 'rate'
+
+    def __init__(self, name, spec):
+        super().__init__(name, spec)
+        self.max_rate = spec['max_rate']
+        self.prev = None
+
+    def check(self, ts, value):
+        prev, self.prev = self.prev, (ts, value)
+        if prev is None or ts <= prev[0]:
+            return None, ''
+        rate = (value - prev[1]) / (ts - prev[0])
+        return abs(rate) > self.max_rate, str(round(rate, 6)) + '/s'
+
+
+class Window(Rule):
+    """Alarm while the average of the last 'size' readings is above 'max' or below 'min'."""
+
+    kind = 'window'
+
+    def __init__(self, name, spec):
+        super().__init__(name, spec)
+        self.size = spec['size']
+        self.max = spec.get('max')
+        self.min = spec.get('min')
+        self.values = deque()
+        self.total = 0.0
+
+    def check(self, ts, value):
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.size:
+            self.total -= self.values.popleft()
+        if len(self.values) < self.size:
+            return None, ''
+        avg = self.total / self.size
+        return (self.max is not None and avg > self.max) or (self.min is not None and avg < self.min), str(round(avg, 6))
+
+
+rule_types = {'threshold': Threshold, 'hysteresis': Hysteresis, 'rate': Rate, 'window': Window}
+
+
+def compile_rule(name, spec):
+    """
+    Build the evaluator of one rule declaration.
+    :param spec: dict with 'type' (see rule_types) and the type's parameters
+    :return: Rule instance
+    """
+    rule_type = rule_types.get(spec.get('type'))
+    if rule_type is None:
+        raise ValueError('Unknown rule type for ' + name + ': ' + str(spec.get('type')))
+    return rule_type(name, spec)
+
+
+class RuleEngine:
+    """
+    Per-device alarm rules. Names in the declaration may be fnmatch patterns ('DHT-*');
+    a device matching patterns gets its own evaluators (and state) the first time it reports.
+    usage: engine = RuleEngine(); for key, state, topic, msg in engine.evaluate(name, ts, value): ...
+    """
+
+    def __init__(self, rules=None):
+        rules = alarm_rules if rules is None else rules
+        self.patterns = [(pattern, specs) for pattern, specs in rules.items() if any(c in pattern for c in '*?[')]
+        self.devices = {name: [compile_rule(name, spec) for spec in specs]
+                        for name, specs in rules.items() if not any(c in name for c in '*?[')}
+        self.declared = list(self.devices)
+        self._lock = threading.Lock()
+
+    def rules_for(self, name):
+        """
+        :return: compiled rules of a device, compiling the matching patterns on first use
+        """
+        rules = self.devices.get(name)
+        if rules is None:
+            rules = self.devices[name] = [compile_rule(name, spec) for pattern, specs in self.patterns
+                                          if fnmatchcase(name, pattern) for spec in specs]
+        return rules
+
+    def evaluate(self, name, ts, value):
+        """
+        Run the rules of one device on a new reading.
+        :param ts: epoch seconds of the reading
+        :param value: reading as float (None is ignored)
+        :return: list of (alarm key, state, topic, message) of the rules whose state is known -
+                 state True with the alarm message, False with the clear message
+        """
+        if value is None:
+            return []
+        results = []
+        with self._lock:
+            for i, rule in enumerate(self.rules_for(name)):
+                state, detail = rule.check(ts, value)
+                if state is not None:
+                    results.append((name + '/' + rule.kind + str(i), state, rule.topic,
+                                    (rule.msg if state else rule.clear_msg) + detail))
+        return results
+
+    def names(self):
+        """
+        :return: device names with explicitly declared (non-pattern) rules
+        """
+        return self.declared
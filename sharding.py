@@ -0,0 +1,42 @@
+# Device partitioning of the sharded manager
+# Every device publishes on its own topic, so the topic is the partition key: manager shard k of N
+# handles the messages whose topic hashes to k. crc32 keeps the assignment identical in every
+# process and across restarts (unlike hash(), which is salted per process).
+import json
+import time
+import zlib
+from init import *
+
+# retained heartbeat of each shard: shard_topic + '<k>'
+shard_topic = comm_topic + 'manager/shard/'
+
+
+def shard_of(key, shards):
+    """
+    :return: shard number (0..shards-1) owning a topic or device name
+    """
+    return zlib.crc32(key.encode('utf-8')) % shards if shards > 1 else 0
+
+
+def parse_shard(args, shards=manager_shards):
+    """
+    Read '--shard k/N' (or '--shard k', N from manager_shards) from the command line.
+    :return: tuple (shard, shards)
+    """
+    for i, arg in enumerate(args):
+        if arg == '--shard' and i + 1 < len(args):
+            part = args[i + 1].split('/')
+            shard, shards = int(part[0]), int(part[1]) if len(part) > 1 else shards
+            if not 0 <= shard < shards:
+                raise ValueError('Shard ' + str(shard) + ' out of range 0..' + str(shards - 1))
+            return shard, shards
+    return 0, 1
+
+
+def heartbeat(shard, shards, topics, stats=None, alive=True):
+    """
+    :param topics: dict topic -> messages handled, the devices this shard has seen
+    :return: JSON heartbeat payload of a shard
+    """
+    return json.dumps({'shard': shard, 'shards': shards, 'alive': alive, 'time': time.time(),
+                       'topics': topics, 'stats': stats or {}}, separators=(',', ':'))
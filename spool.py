@@ -0,0 +1,172 @@
+# Outbound publish spool
+# Publishes made while the broker is unreachable are appended to a bounded file instead of
+# being dropped, and sent in their original order once the client is connected again. While
+# anything is spooled, new publishes are appended behind it, so the order per topic holds.
+# Record: '<IHBB' (payload length, topic length, qos, retain) + topic + payload. The read
+# position is kept in <spool>.pos, so a restart resumes where the last drain stopped
+# (messages of an interrupted batch may be sent twice, never lost).
+import os
+import re
+import time
+import struct
+import threading
+from init import *
+from icecream import ic
+
+record = struct.Struct('<IHBB')
+
+
+def spool_path(name):
+    """
+    :return: spool file of a client/process name under spool_dir
+    """
+    return os.path.join(spool_dir, re.sub(r'[^\w.-]', '_', name) + '.spool')
+
+
+class Spool:
+    """
+    Bounded append-only FIFO of outbound messages on disk.
+    usage: spool.put(topic, payload) while disconnected; spool.drain_async(publish, client.is_connected) on connect
+    """
+
+    def __init__(self, path, max_bytes=spool_max_bytes, batch=spool_batch, rate=spool_rate, fsync=spool_fsync):
+        self.path = path
+        self.pos_path = path + '.pos'
+        self.max_bytes = max_bytes
+        self.batch = batch
+        self.rate = rate
+        self.fsync = fsync
+        self.file = None
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.read_pos = 0
+        if os.path.exists(self.pos_path):
+            with open(self.pos_path) as f:
+                self.read_pos = min(int(f.read() or 0), self.size)
+        self.spooled = self.sent = self.dropped = 0
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._drainer = None
+
+    def pending(self):
+        """
+        :return: True while spooled messages wait to be sent
+        """
+        return self.size > self.read_pos
+
+    def put(self, topic, payload, qos=0, retain=False):
+        """
+        Append one message.
+        :return: True if spooled, False if dropped because the spool is full
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        name = topic.encode('utf-8')
+        data = record.pack(len(payload), len(name), qos, bool(retain)) + name + payload
+        with self._lock:
+            if self.size - self.read_pos + len(data) > self.max_bytes:
+                self.dropped += 1
+                ic('Spool full, message dropped: ' + self.path)
+                return False
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self.file = open(self.path, 'ab')
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.size += len(data)
+            self.spooled += 1
+        return True
+
+    def read_batch(self):
+        """
+        :return: list of (topic, payload, qos, retain, end offset) of the next batch
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.read_pos)
+            buf = f.read(min(self.size - self.read_pos, 1 << 20))
+        messages, offset = [], 0
+        while len(messages) < self.batch and offset + record.size <= len(buf):
+            size, topic_size, qos, retain = record.unpack_from(buf, offset)
+            start = offset + record.size
+            end = start + topic_size + size
+            if end > len(buf):
+                if not messages and end - offset > len(buf):  # one message larger than the read window
+                    with open(self.path, 'rb') as f:
+                        f.seek(self.read_pos)
+                        buf = f.read(end - offset)
+                    continue
+                break
+            messages.append((buf[start:start + topic_size].decode('utf-8'), buf[start + topic_size:end],
+                             qos, bool(retain), self.read_pos + end))
+            offset = end
+        return messages
+
+    def commit(self, pos):
+        """
+        Record that everything before pos was sent; an emptied spool is removed.
+        """
+        with self._lock:
+            self.read_pos = pos
+            if pos >= self.size:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                for path in (self.path, self.pos_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.size = self.read_pos = 0
+                return
+        tmp = self.pos_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(pos))
+        os.replace(tmp, self.pos_path)
+
+    def drain(self, publish, connected=lambda: True):
+        """
+        Send the spooled messages in order, batch by batch at no more than rate messages/sec.
+        Stops when connected() turns False or publish fails; the rest stays spooled.
+        :param publish: called as publish(topic, payload, qos, retain), returns True when accepted
+        :return: number of messages sent
+        """
+        sent = 0
+        with self._drain_lock:
+            while self.pending() and connected():
+                started = time.monotonic()
+                messages = self.read_batch()
+                if not messages:  # a record torn by a crash while appending
+                    ic('Spool tail discarded: ' + self.path)
+                    self.commit(self.size)
+                    break
+                done = self.read_pos
+                for topic, payload, qos, retain, end in messages:
+                    if not publish(topic, payload, qos, retain):
+                        self.commit(done)
+                        self.sent += sent
+                        return sent
+                    done = end
+                    sent += 1
+                self.commit(done)
+                if self.rate:
+                    delay = len(messages) / self.rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        self.sent += sent
+        if sent:
+            ic('Spool drained: ' + str(sent) + ' message(s) from ' + self.path)
+        return sent
+
+    def drain_async(self, publish, connected=lambda: True):
+        """
+        Run drain() in a background thread (from an on_connect callback), unless one is running.
+        """
+        if not self.pending() or (self._drainer is not None and self._drainer.is_alive()):
+            return
+        self._drainer = threading.Thread(target=self.drain, args=(publish, connected), name='spool-drain', daemon=True)
+        self._drainer.start()
+
+    def close(self):
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,54 @@
+# Alarm rules of the manager's fallback poll
+# usage: python -m pytest test_manager.py
+import time
+import paho.mqtt.client as mqtt
+import pytest
+import data_acquisition as da
+import manager
+import payload
+from init import *
+from rules import RuleEngine
+
+
+class Client:
+    """Stand-in MQTT client of the manager: records what it publishes."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, msg, qos=0, retain=False):
+        self.messages.append((topic, msg))
+        return mqtt.MQTTMessageInfo(len(self.messages))
+
+    def is_connected(self):
+        return True
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'manager.db')
+    monkeypatch.setattr(da, 'db_name', path)
+    da.init_db(path)
+    monkeypatch.setattr(manager, 'rule_engine', RuleEngine())
+    monkeypatch.setattr(manager, 'alarms', None)
+    monkeypatch.setattr(manager, 'evaluated', {})
+    return path
+
+
+def store_meter(value, sampled):
+    """Store a meter reading taken at epoch sec `sampled`, without evaluating the rules."""
+    manager.insert_DB(comm_topic + '/Home/pub', payload.encode('meter', 'Meter', (value, 0.01), ts=sampled))
+
+
+def test_fallback_skips_late_reading(db):
+    store_meter(5.0, time.time() - alarm_max_age - 3600)
+    client = Client()
+    manager.check_DB_for_change(client)
+    assert client.messages == []
+
+
+def test_fallback_alarms_current_reading(db):
+    store_meter(5.0, time.time())
+    client = Client()
+    manager.check_DB_for_change(client)
+    assert any('5.0' in msg for topic, msg in client.messages)